@@ -1,17 +1,17 @@
 import logging
 
-import re
-import time
-
-import asyncio
+import serial
 
 from functools import wraps
 from threading import RLock
 
-from .const import MUTE_KEY, VOLUME_KEY, POWER_KEY, SOURCE_KEY, ZONE_KEY
-from .config import DEVICE_CONFIG, PROTOCOL_CONFIG, RS232_RESPONSE_PATTERNS, pattern_to_dictionary, get_with_log
+from .const import ASCII, MUTE_KEY, VOLUME_KEY, POWER_KEY, SOURCE_KEY, ZONE_KEY
+from .config import DEVICE_CONFIG, PROTOCOL_CONFIG
+from .scene import CONF_SCENES, compile_scenes, load_scenes
+from .reconcile import compile_changes, expected_state, state_differences
 from .protocol_sync import get_sync_rs232_protocol
 from .protocol_async import get_async_rs232_protocol
+from .transports import TRANSPORT_AUTO
 
 # FIXME:
 # The Anthem has the ability to set a "transmit" status on its RS232 port, which, acc'd the documentation, 
@@ -31,6 +31,92 @@ class AmpControlBase(object):
     AmpliferControlBase amplifier interface
     """
 
+    def __init__(self, protocol_type, serial_client, scenes = {}, series: str = None, serial_port_path: str = None):
+        self._protocol_type = protocol_type
+        self._serial_client = serial_client
+        self.series = series
+        self.serial_port_path = serial_port_path
+        self._engine = serial_client.engine
+
+        self._scenes = {}
+        self.define_scenes(scenes)
+
+        self._zone_state = {}      # zone -> last known state (power, mute, volume, source)
+        self._state_listeners = []
+
+    def add_state_listener(self, callback):
+        """Invoke callback(zone: int, state: dict) with the full known zone state whenever it is updated"""
+        self._state_listeners.append(callback)
+
+    def remove_state_listener(self, callback):
+        if callback in self._state_listeners:
+            self._state_listeners.remove(callback)
+
+    def _update_state(self, result: dict):
+        """Merge a parsed reply or event from the amplifier into the known zone state"""
+        zone, changes = self._engine.zone_state(result)
+        if zone is None or not changes:
+            return
+
+        state = self._zone_state.setdefault(zone, {})
+        state.update(changes)
+        for listener in self._state_listeners:
+            listener(zone, dict(state))
+
+    def define_scenes(self, scenes: dict):
+        """
+        Validate and precompile named scenes (see anthemav_serial.scene), replacing any with the same name
+        :param scenes: dictionary of scene name -> list of steps, e.g. from load_scenes()
+        """
+        self._scenes.update(compile_scenes(self._engine, scenes))
+
+    @property
+    def engine(self):
+        """I/O free protocol core (encoding, framing and parsing) used by this controller"""
+        return self._engine
+
+    @property
+    def scenes(self) -> list:
+        """Names of all defined scenes"""
+        return list(self._scenes)
+
+    def run_scene(self, name: str):
+        """
+        Execute all commands of a previously defined scene
+        :param name: scene name
+        """
+        raise NotImplemented()
+
+    def apply_state(self, zone: int, desired: dict) -> dict:
+        """
+        Send only the commands needed to bring a zone from its last known state to the desired state,
+        then read the zone status once to verify (see anthemav_serial.reconcile)
+        :param desired: any of 'power', 'mute', 'volume' (dB) and 'source'
+        :return: fields that did not reach the desired value (empty once converged)
+        """
+        raise NotImplemented()
+
+    def apply_states(self, desired_states: dict) -> dict:
+        """
+        Like apply_state for several zones, merging all of their commands into one schedule
+        :param desired_states: zone -> desired state
+        :return: zone -> fields that did not reach the desired value, for zones that did not converge
+        """
+        raise NotImplemented()
+
+    def _unknown_zones(self, desired_states: dict) -> list:
+        """Zones whose state has never been read, so must be queried before comparing"""
+        return [ zone for zone in desired_states if zone not in self._zone_state ]
+
+    def _unconverged(self, zones: list, desired_states: dict) -> dict:
+        unconverged = {}
+        for zone in zones:
+            differences = state_differences(self._zone_state.get(zone, {}), expected_state(desired_states[zone]))
+            if differences:
+                LOG.warning(f"Zone {zone} did not reach desired state {differences} (now {self._zone_state.get(zone)})")
+                unconverged[zone] = differences
+        return unconverged
+
     def is_connected(self):
         """
         Returns True if the amplifier is connected and responding
@@ -43,6 +129,13 @@ class AmpControlBase(object):
         """
         raise NotImplemented()
 
+    def send_request(self, request: bytes, wait_for_reply=True, delay_after: float = 0):
+        """
+        Send an already framed request (see engine.frame), e.g. several commands in one write
+        :param delay_after: seconds the device ignores requests after this one (e.g. after power on)
+        """
+        raise NotImplemented()
+
     def set_power(self, zone: int, power: bool):
         """
         Turn zone on or off
@@ -84,9 +177,28 @@ class AmpControlBase(object):
         raise NotImplemented()
 
     def zone_status(self, zone: int) -> dict:
-        """Return a dictionary containing status details for the zone"""
+        """
+        Return a dictionary containing status details for the zone (on protocols without a zone_status
+        reply, e.g. Gen2, power, mute, volume and source are queried one by one)
+        """
         raise NotImplemented()
 
+    def _merge_field_status(self, result: dict, response: str) -> bool:
+        """Merge a per field status reply into result; False once the zone is off (nothing else to read)"""
+        parsed = self._engine.parse_event(response)
+        if parsed:
+            result.update(parsed)
+        return result.get(POWER_KEY) is not False
+
+    def _line_received(self, line: str):
+        """Track zone state from every line received, replies as well as echoed events"""
+        self._update_state(self._engine.parse_event(line))
+
+    def _reply_query(self, request: bytes) -> str:
+        """First query command in a framed request, which the line read back must answer (None if any line will do)"""
+        commands = self._engine.split(request.decode(ASCII).strip())
+        return next((command for command in commands if self._engine.is_query(command)), None)
+
 
 def _prepare_config(amp_series, serial_config_overrides):
     # sanity check the provided amplifier type
@@ -104,36 +216,16 @@ def _prepare_config(amp_series, serial_config_overrides):
 
     return (config, protocol_type, serial_config)
 
-def _format(protocol_type: str, format_code: str, args = {}):
-    config = PROTOCOL_CONFIG[protocol_type]
-
-    command = config['commands'].get(format_code)
-    if not command:
-        LOG.error("Invalid command format '{format_code}' for protocol {protocol_type}; returning None")
-        return None
-
-    command += str(config['command_eol'])
-    return command.format(**args).encode('ascii')
-
-def _set_volume_cmd(protocol_type, zone: int, volume: int) -> bytes:
+def _set_volume_args(zone: int, volume: int) -> dict:
 #    assert zone in _get_config(protocol_type, 'zones')
     volume = int(max(0, min(volume, MAX_VOLUME)))
-    return _format(protocol_type, 'set_volume', args = { ZONE_KEY: zone, VOLUME_KEY: volume })
+    return { ZONE_KEY: zone, VOLUME_KEY: volume }
 
-def _handle_message(protocol_type, text: str):
-    """
-    Handles an arbitrary message from the RS232 device. Works both for replies
-    to queries as well as streams of messages echoed from a device.
-    """
-    for pattern_name, pattern in RS232_RESPONSE_PATTERNS[protocol_type].items():
-        match = re.match(pattern, text)
-        if match:
-            LOG.info(f"Response for pattern {pattern_name} for text {text}")
-            result = pattern_to_dictionary(protocol_type, match, text)
-            LOG.info(f"Parsed response text {text}: {result}")
-            return result
-    LOG.info(f"Found no pattern matching response: {text}")
-    return None
+def _power_command(power: bool) -> str:
+    return 'power_on' if power else 'power_off'
+
+def _mute_command(mute: bool) -> str:
+    return 'mute_on' if mute else 'mute_off'
 
 def get_amp_controller(amp_series: str, serial_port_path, serial_config_overrides = {}):
     """
@@ -156,56 +248,61 @@ def get_amp_controller(amp_series: str, serial_port_path, serial_config_override
 
     class AmpControlSync(AmpControlBase):
 
-        def __init__(self, protocol_type, serial_client):
-            self._protocol_type = protocol_type
-            self._serial_client = serial_client
-            self._config = PROTOCOL_CONFIG[protocol_type]
-
         @synchronized
         def is_connected(self):
-            self.send_command('query_version')
-            version = self._serial_client.read()
-            if version:
-                # command returns: unit type, version, build date   (AVM 2,Version 1.00,Jun 26 2000)
-                connected = '(AVM' in version
-                LOG.debug(f"{self._serial_client} is_connected() == {connected} {version}")
-                return connected
-            return False
+            try:
+                version = self.send_command('query_version')
+            except serial.SerialTimeoutException:
+                return False
+            # command returns: unit type, version, build date   (AVM 2,Version 1.00,Jun 26 2000)
+            connected = self._engine.is_version(version)
+            LOG.debug(f"{self._serial_client} is_connected() == {connected} {version}")
+            return connected
 
         @synchronized
         def send_command(self, command: str, args = {}, wait_for_reply=True):
-            cmd = _format(self._protocol_type, command, args)
-            self._serial_client.send(cmd)
-            if wait_for_reply:
-                return self._serial_client.read()
+            return self.send_request(self._engine.encode(command, args), wait_for_reply=wait_for_reply)
+
+        @synchronized
+        def send_request(self, request: bytes, wait_for_reply=True, delay_after: float = 0):
+            self._serial_client.send(request)
+            if delay_after:
+                self._serial_client.delay_requests(delay_after)
+            if not wait_for_reply:
+                return None
+
+            # unsolicited events (e.g. front panel changes) may arrive before the reply
+            query = self._reply_query(request)
+            while True:
+                line = self._serial_client.read()
+                if query is None or self._engine.is_reply(query, line):
+                    return line
+                LOG.debug(f"Skipped {line} while waiting for the reply to {query}")
+                self._line_received(line)
 
         @synchronized
         def set_power(self, zone: int, power: bool):
             #    assert zone in _get_config(protocol_type, 'zones')
-            if power:
-                cmd = 'power_on'
-            else:
-                cmd = 'power_off'
+            cmd = _power_command(power)
             self.send_command(cmd, args = { ZONE_KEY: zone }, wait_for_reply=False)
 
+            # Anthem amps can't accept more RS232 requests for several seconds after powering up
+            if power:
+                self._serial_client.delay_requests(self._engine.delay_after_power_on)
+
         @synchronized
         def set_mute(self, zone: int, mute: bool):
-            if mute:
-                cmd = 'mute_on'
-            else:
-                cmd = 'mute_off'
-            self.send_command(cmd, args = { ZONE_KEY: zone }, wait_for_reply=False)
+            self.send_command(_mute_command(mute), args = { ZONE_KEY: zone }, wait_for_reply=False)
 
         @synchronized
         def set_volume(self, zone: int, volume: int):
-            request = _set_volume_cmd(self._protocol_type, zone, volume)
-            self._serial_client.send(request)
+            self.send_command('set_volume', args = _set_volume_args(zone, volume), wait_for_reply=False)
 
         @synchronized
         def set_source(self, zone: int, source: int):
             #    assert zone in _get_config(protocol_type, 'zones')
             #    assert source in _get_config(protocol_type, 'sources')
-            self.send_command('set_source', args = { ZONE_KEY: zone, SOURCE_KEY: source }, wait_for_reply=False)
+            self.send_command('source_select', args = { ZONE_KEY: zone, SOURCE_KEY: source }, wait_for_reply=False)
 
         @synchronized
         def volume_up(self, zone: int):
@@ -218,29 +315,52 @@ def get_amp_controller(amp_series: str, serial_port_path, serial_config_override
         @synchronized
         def zone_status(self, zone: int) -> dict:
             """Return a dictionary containing status details for the zone"""
-            self.send_command('zone_status', { ZONE_KEY: zone })
-            response = self._serial_client.read()
+            if not self._engine.has_zone_status:
+                result = { ZONE_KEY: zone }
+                for name in self._engine.field_status_queries():
+                    if not self._merge_field_status(result, self.send_command(name, { ZONE_KEY: zone })):
+                        break
+                self._update_state(result)
+                return result
+
+            response = self.send_command('zone_status', { ZONE_KEY: zone })
             LOG.debug("Received zone %d status response %s", zone, response)
+            result = self._engine.parse_zone_status(response)
+            self._update_state(result)
+            return result
 
-            if "Main Off" in response:
-                return { ZONE_KEY: 1, POWER_KEY: False, MUTE_KEY: True, VOLUME_KEY: 0 }
-            elif response == "Zone2 Off":
-                return { ZONE_KEY: 2, POWER_KEY: False, MUTE_KEY: True, VOLUME_KEY: 0 }
-            elif response == "Zone3 Off":
-                return { ZONE_KEY: 3, POWER_KEY: False, MUTE_KEY: True, VOLUME_KEY: 0 }
+        @synchronized
+        def run_scene(self, name: str):
+            for write in self._scenes[name]:
+                self.send_request(write.request, wait_for_reply=False, delay_after=write.delay_after)
 
-            result = _handle_message(self._protocol_type, response)
-            result[POWER_KEY] = True # must manually inject power status if on, since this is implied by a response
-            return result
+        @synchronized
+        def apply_state(self, zone: int, desired: dict) -> dict:
+            return self.apply_states({ zone: desired }).get(zone, {})
+
+        @synchronized
+        def apply_states(self, desired_states: dict) -> dict:
+            for zone in self._unknown_zones(desired_states):
+                self.zone_status(zone)
+
+            writes, zones = compile_changes(self._engine, self._zone_state, desired_states)
+            for write in writes:
+                self.send_request(write.request, wait_for_reply=False, delay_after=write.delay_after)
+
+            for zone in zones:
+                self.zone_status(zone)
+            return self._unconverged(zones, desired_states)
 
     serial_client = get_sync_rs232_protocol(serial_port_path, serial_config, PROTOCOL_CONFIG[protocol_type])
-    return AmpControlSync(protocol_type, serial_client)
+    return AmpControlSync(protocol_type, serial_client, scenes=config.get(CONF_SCENES) or {},
+                          series=amp_series, serial_port_path=serial_port_path)
 
 #### ASYNCHRONOUS CLIENT
-async def get_async_amp_controller(amp_series, serial_port_path, loop, serial_config_overrides = {}):
+async def get_async_amp_controller(amp_series, serial_port_path, loop, serial_config_overrides = {}, transport=TRANSPORT_AUTO):
     """
     Return asynchronous version of amplifier control interface
     :param serial_port_path: serial port, i.e. '/dev/ttyUSB0'
+    :param transport: 'serial', 'fd', 'tcp' or 'auto' (see anthemav_serial.transports)
     :return: asynchronous implementation of amplifier control interface
     """
 
@@ -249,57 +369,58 @@ async def get_async_amp_controller(amp_series, serial_port_path, loop, serial_co
         return None
 
     class AmpControlAsync(AmpControlBase):
-        def __init__(self, protocol_type, serial_client):
-            self._protocol_type = protocol_type
-            self._serial_client = serial_client
-
-        async def send_command(self, command: str, args = {}, wait_for_reply=False):
-            cmd = _format(self._protocol_type, command, args)
-            LOG.debug("Sending command %s", cmd)
-            await self._serial_client.send(cmd)
-
-            LOG.debug(f"Waiting for reply for {cmd}...")
-            response = await asyncio.wait_for( self._protocol.read(), 1.0 )
-            # response = await self._protocol.read()
 
-            LOG.debug(f"Received {cmd} response: {response}")
+        def __init__(self, protocol_type, serial_client, **kwargs):
+            super().__init__(protocol_type, serial_client, **kwargs)
+
+            # zone state follows every line received, so echoed events (e.g. front panel changes) are tracked too
+            serial_client.add_listener(self._line_received)
+
+        async def send_command(self, command: str, args = {}, wait_for_reply=True):
+            return await self.send_request(self._engine.encode(command, args), wait_for_reply=wait_for_reply)
+
+        async def send_request(self, request: bytes, wait_for_reply=True, delay_after: float = 0):
+            LOG.debug("Sending command %s", request)
+            await self._serial_client.send(request)
+            if delay_after:
+                self._serial_client.delay_requests(delay_after)
+            if not wait_for_reply:
+                return None
+
+            LOG.debug(f"Waiting for reply for {request}...")
+            query = self._reply_query(request)
+            while True:
+                response = await self._serial_client.read()
+                if response is None or query is None or self._engine.is_reply(query, response):
+                    break
+                # unsolicited events already updated the zone state through _line_received
+                LOG.debug(f"Skipped {response} while waiting for the reply to {query}")
+
+            LOG.debug(f"Received {request} response: {response}")
             return response
 
         async def is_connected(self):
-            version = await self.send_command('query_version', wait_for_reply=True)
-            if version:
-                # returns: unit type, version, build date   (AVM 2,Version 1.00,Jun 26 2000)
-                LOG.debug(f"amp.is_connected returned {version}")
-                return version.contain('(')
-            return False
+            version = await self.send_command('query_version')
+            # returns: unit type, version, build date   (AVM 2,Version 1.00,Jun 26 2000)
+            LOG.debug(f"amp.is_connected returned {version}")
+            return self._engine.is_version(version)
 
         async def set_power(self, zone: int, power: bool):
-            if power:
-                cmd = 'power_on'
-            else:
-                cmd = 'power_off'
+            cmd = _power_command(power)
             await self.send_command(cmd, args = { ZONE_KEY: zone }, wait_for_reply=False)
 
-            # FIXME: move out of this "generic" code as it should be agnostic to the amp
-            # special case for powering on, since Anthem amps can't accept more RS232 requests
-            # for several seconds after powering up
-            #if request in [ "P1P1\n", "P2P1\n", "P1P3\n" ]:
-            if cmd == 'power_on':
-                self._serial_client.delay_requests(2.0) # self._config['delay_after_power_on']
+            # Anthem amps can't accept more RS232 requests for several seconds after powering up
+            if power:
+                self._serial_client.delay_requests(self._engine.delay_after_power_on)
 
         async def set_mute(self, zone: int, mute: bool):
-            if mute:
-                cmd = 'mute_on'
-            else:
-                cmd = 'mute_off'
-            await self.send_command(cmd, args = { ZONE_KEY: zone }, wait_for_reply=False)
+            await self.send_command(_mute_command(mute), args = { ZONE_KEY: zone }, wait_for_reply=False)
 
         async def set_volume(self, zone: int, volume: int):
-            request = _set_volume_cmd(self._protocol_type, zone, volume)
-            await self._serial_client.send(request, wait_for_reply=False)
+            await self.send_command('set_volume', args = _set_volume_args(zone, volume), wait_for_reply=False)
 
         async def set_source(self, zone: int, source: int):
-            await self.send_command('set_source', args = { ZONE_KEY: zone, SOURCE_KEY: source }, wait_for_reply=False)
+            await self.send_command('source_select', args = { ZONE_KEY: zone, SOURCE_KEY: source }, wait_for_reply=False)
 
         async def volume_up(self, zone: int):
             await self.send_command('volume_up', args = { ZONE_KEY: zone }, wait_for_reply=False)
@@ -308,20 +429,38 @@ async def get_async_amp_controller(amp_series, serial_port_path, loop, serial_co
             await self.send_command('volume_down', args = { ZONE_KEY: zone }, wait_for_reply=False)
 
         async def zone_status(self, zone: int) -> dict:
-            """Return a dictionary containing status details for the zone"""
+            """Return a dictionary containing status details for the zone (zone state is updated by _line_received)"""
+            if not self._engine.has_zone_status:
+                result = { ZONE_KEY: zone }
+                for name in self._engine.field_status_queries():
+                    if not self._merge_field_status(result, await self.send_command(name, { ZONE_KEY: zone })):
+                        break
+                return result
+
             response = await self.send_command('zone_status', { ZONE_KEY: zone })
+            return self._engine.parse_zone_status(response)
 
-            if "Main Off" in response:
-                return { ZONE_KEY: 1, POWER_KEY: False }
-            elif response == "Zone2 Off":
-                return { ZONE_KEY: 2, POWER_KEY: False }
-            elif response == "Zone3 Off":
-                return { ZONE_KEY: 3, POWER_KEY: False }
+        async def run_scene(self, name: str):
+            for write in self._scenes[name]:
+                await self.send_request(write.request, wait_for_reply=False, delay_after=write.delay_after)
 
-            result = _handle_message(self._protocol_type, response)  # FIXME: hint at which response pattern to match
-            result[POWER_KEY] = True # manually inject power status, since this is implied by this response
-            return result
+        async def apply_state(self, zone: int, desired: dict) -> dict:
+            return (await self.apply_states({ zone: desired })).get(zone, {})
+
+        async def apply_states(self, desired_states: dict) -> dict:
+            for zone in self._unknown_zones(desired_states):
+                await self.zone_status(zone)
+
+            writes, zones = compile_changes(self._engine, self._zone_state, desired_states)
+            for write in writes:
+                await self.send_request(write.request, wait_for_reply=False, delay_after=write.delay_after)
+
+            for zone in zones:
+                await self.zone_status(zone)
+            return self._unconverged(zones, desired_states)
 
 
-    serial_client = await get_async_rs232_protocol(serial_port_path, serial_config, PROTOCOL_CONFIG[protocol_type], loop)
-    return AmpControlAsync(protocol_type, serial_client)
\ No newline at end of file
+    serial_client = await get_async_rs232_protocol(serial_port_path, serial_config, PROTOCOL_CONFIG[protocol_type], loop,
+                                                   transport=transport)
+    return AmpControlAsync(protocol_type, serial_client, scenes=config.get(CONF_SCENES) or {},
+                           series=amp_series, serial_port_path=serial_port_path)
@@ -0,0 +1,201 @@
+"""Command line interface executing a stream of Anthem RS232 commands over a single connection
+
+Each input line is a command name from the protocol yaml followed by key=value arguments:
+
+    power_on zone=1
+    set_volume zone=1 volume=-30
+    zone_status zone=1
+
+Commands are executed as they are read. Commands already waiting in the input are pipelined into a
+single write on protocols with a multi-command separator (Gen1 ';'); a batch ends at the first query
+(whose reply is read before continuing) or power on (after which the amp ignores requests for a while).
+Replies, and any events the amplifier sends while a reply is awaited, are printed to stdout as JSON
+lines as they arrive.
+"""
+
+import sys
+import json
+import queue
+import shlex
+import logging
+import argparse
+import threading
+
+import serial
+
+from . import _prepare_config
+from .const import ASCII, CONF_THROTTLE_RATE, CONF_TIMEOUT, MAX_COMMANDS_PER_WRITE
+from .config import DEVICE_CONFIG, PROTOCOL_CONFIG
+from .protocol import RS232Protocol
+from .protocol_sync import get_sync_rs232_protocol
+
+LOG = logging.getLogger(__name__)
+
+_END_OF_INPUT = object()
+
+def parse_command_line(line: str):
+    """
+    Parse 'set_volume zone=1 volume=-30' into ('set_volume', { 'zone': '1', 'volume': '-30' })
+    :return: (name, args) or None for blank lines and comments
+    """
+    tokens = shlex.split(line, comments=True)
+    if not tokens:
+        return None
+
+    args = {}
+    for token in tokens[1:]:
+        key, sep, value = token.partition('=')
+        if not sep:
+            raise ValueError(f"Expected key=value argument, got '{token}'")
+        args[key] = value
+    return (tokens[0], args)
+
+def _format_args(engine: RS232Protocol, name: str, args: dict) -> dict:
+    """
+    Convert the arguments the command formats as numbers (e.g. '{channel:04}') to int; all others are kept
+    as typed, so zero padded values (e.g. 'name=007') are sent unchanged
+    """
+    specs = engine.command_format_specs(name)
+    return { key: int(value) if specs.get(key) else value for key, value in args.items() }
+
+def _read_input(stream, commands: queue.Queue):
+    for line in stream:
+        commands.put(line)
+    commands.put(_END_OF_INPUT)
+
+
+class BatchRunner(object):
+    """
+    Executes commands from a queue of input lines, pipelining whatever is already available
+    """
+
+    def __init__(self, engine: RS232Protocol, serial_client=None, output=sys.stdout):
+        self._engine = engine
+        self._serial_client = serial_client  # None for a dry run
+        self._output = output
+        self.errors = 0
+
+        self._max_batch = MAX_COMMANDS_PER_WRITE if engine.supports_multiple_commands else 1
+
+    def run(self, commands: queue.Queue):
+        done = False
+        while not done:
+            batch = []
+            line = commands.get()
+            while True:
+                if line is _END_OF_INPUT:
+                    done = True
+                    break
+
+                command = self._encode(line)
+                if command:
+                    batch.append(command)
+                    name, _, text = command
+                    if len(batch) >= self._max_batch or self._engine.is_query(text) or name == 'power_on':
+                        break
+
+                try:
+                    line = commands.get_nowait()
+                except queue.Empty:
+                    break
+
+            if batch:
+                self._execute(batch)
+        return self.errors
+
+    def _encode(self, line: str):
+        try:
+            parsed = parse_command_line(line)
+            if not parsed:
+                return None
+            name, args = parsed
+            text = self._engine.format_command(name, _format_args(self._engine, name, args))
+            if text is None:
+                raise ValueError(f"Unknown command '{name}'")
+            return (name, args, text)
+        except (ValueError, KeyError, IndexError) as e:
+            LOG.error(f"Skipping '{line.strip()}': {e}")
+            self.errors += 1
+            return None
+
+    def _execute(self, batch: list):
+        request = self._engine.frame([ text for _, _, text in batch ])
+        if not self._serial_client:
+            self._print({ 'commands': [ name for name, _, _ in batch ], 'write': request.decode(ASCII) })
+            return
+
+        self._serial_client.send(request)
+
+        name, args, text = batch[-1]
+        if name == 'power_on':
+            self._serial_client.delay_requests(self._engine.delay_after_power_on)
+
+        if self._engine.is_query(text):
+            try:
+                response = self._serial_client.read()
+                while not self._engine.is_reply(text, response):
+                    # unsolicited events (e.g. front panel changes) may arrive before the reply
+                    self._print({ 'event': response, 'result': self._engine.parse_event(response) })
+                    response = self._serial_client.read()
+            except serial.SerialTimeoutException as e:
+                LOG.error(f"No reply to {name}: {e}")
+                self.errors += 1
+                self._print({ 'command': name, 'args': args, 'error': 'timeout' })
+                return
+            result = self._engine.parse_event(response)
+            self._print({ 'command': name, 'args': args, 'response': response, 'result': result })
+
+    def _print(self, result: dict):
+        self._output.write(json.dumps(result) + '\n')
+        self._output.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Execute a stream of Anthem RS232 commands over one connection')
+    parser.add_argument('input', nargs='?', default='-', help='file of commands, one per line (default: stdin)')
+    parser.add_argument('--series', default='d2v', choices=sorted(DEVICE_CONFIG), help='Anthem amplifier series')
+    parser.add_argument('--tty', help='/dev/tty to use (e.g. /dev/ttyUSB0 or socket://localhost:4999)')
+    parser.add_argument('--baud', type=int, help='baud rate')
+    parser.add_argument('--min-time-between-commands', type=float, help='override the throttle rate (seconds)')
+    parser.add_argument('--timeout', type=float, help='override the reply timeout (seconds)')
+    parser.add_argument('--dry-run', action='store_true', help='only print the encoded writes, do not open the port')
+    parser.add_argument('--debug', action='store_true', help='enable debug logging')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG if args.debug else logging.WARNING,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if not args.tty and not args.dry_run:
+        parser.error('--tty is required unless --dry-run')
+
+    serial_overrides = {}
+    if args.baud:
+        serial_overrides['baudrate'] = args.baud
+    if args.timeout:
+        serial_overrides[CONF_TIMEOUT] = args.timeout
+
+    (config, protocol_type, serial_config) = _prepare_config(args.series, serial_overrides)
+
+    communication_config = dict(PROTOCOL_CONFIG[protocol_type])
+    if args.min_time_between_commands is not None:
+        communication_config[CONF_THROTTLE_RATE] = args.min_time_between_commands
+    if args.timeout:
+        communication_config[CONF_TIMEOUT] = args.timeout
+
+    if args.dry_run:
+        serial_client = None
+        engine = RS232Protocol(communication_config)
+    else:
+        serial_client = get_sync_rs232_protocol(args.tty, serial_config, communication_config)
+        engine = serial_client.engine
+
+    stream = sys.stdin if args.input == '-' else open(args.input, 'r', encoding=ASCII)
+    commands = queue.Queue()
+    threading.Thread(target=_read_input, args=(stream, commands), daemon=True).start()
+
+    errors = BatchRunner(engine, serial_client).run(commands)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
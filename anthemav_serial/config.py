@@ -5,6 +5,8 @@ import yaml
 import logging
 import pprint as pp
 
+from string import Formatter
+
 LOG = logging.getLogger(__name__)
 
 DEVICE_CONFIG = {}
@@ -37,22 +39,20 @@ def _load_config_dir(directory):
 
     return config_tree
 
+def convert_boolean_fields(result: dict, boolean_fields) -> dict:
+    """Replace '0' and '1' values of the boolean fields with False and True (in place)"""
+    for field in boolean_fields:
+        value = result.get(field)
+        if value == '0':
+            result[field] = False
+        elif value == '1':
+            result[field] = True
+    return result
+
 def pattern_to_dictionary(protocol_type, match, source_text: str) -> dict:
-    """Convert the pattern to a dictionary, replacing 0 and 1's with True/False"""
-    LOG.info(f"Pattern matching {source_text} {match}")
-    d = match.groupdict()
-            
-    # type convert any pre-configured fields
-    # TODO: this could be a lot more efficient LOL
-    boolean_fields = PROTOCOL_CONFIG[protocol_type].get('boolean_fields')
-    for k, v in d.items():
-        if k in boolean_fields:
-            # replace and 0 or 1 with True or False
-            if v == '0':
-                d[k] = False
-            elif v == '1':
-                d[k] = True
-    return d
+    """Convert the pattern to a dictionary, replacing 0 and 1's with True/False (see RS232Protocol.match_response)"""
+    LOG.debug(f"Pattern matching {source_text} {match}")
+    return convert_boolean_fields(match.groupdict(), PROTOCOL_CONFIG[protocol_type].get('boolean_fields') or [])
 
 def get_with_log(name, dictionary, key: str):
     value = dictionary.get(key)
@@ -75,9 +75,40 @@ def _precompile_response_patterns():
         precompiled[protocol_type] = patterns
     return precompiled
 
+def _command_to_pattern(command_format: str):
+    """Convert a command format (e.g. 'P{zone}VM{volume}') into a pattern that parses a command back"""
+    pattern = ''
+    for literal, field, _, _ in Formatter().parse(command_format):
+        pattern += re.escape(literal)
+        if field:
+            pattern += f"(?P<{field}>.+?)"
+    return re.compile(f"^{pattern}$")
+
+def _precompile_command_patterns():
+    """Precompile patterns for all commands, most specific (longest literal text) first"""
+    precompiled = {}
+    for protocol_type, config in PROTOCOL_CONFIG.items():
+        def literal_length(item):
+            return sum(len(literal) for literal, _, _, _ in Formatter().parse(item[1]))
+
+        patterns = {}
+        for name, command_format in sorted(config['commands'].items(), key=literal_length, reverse=True):
+            patterns.setdefault(name, _command_to_pattern(command_format))
+        precompiled[protocol_type] = patterns
+    return precompiled
+
+def match_command(protocol_type, text: str):
+    """Return (command name, args) for the command that formats to text, or (None, {}) if unknown"""
+    for name, pattern in RS232_COMMAND_PATTERNS[protocol_type].items():
+        match = pattern.match(text)
+        if match:
+            return (name, match.groupdict())
+    return (None, {})
+
 
 config_dir = os.path.dirname(__file__)
 DEVICE_CONFIG = _load_config_dir(f"{config_dir}/series")
 PROTOCOL_CONFIG = _load_config_dir(f"{config_dir}/protocols")
 
-RS232_RESPONSE_PATTERNS = _precompile_response_patterns()
\ No newline at end of file
+RS232_RESPONSE_PATTERNS = _precompile_response_patterns()
+RS232_COMMAND_PATTERNS = _precompile_command_patterns()
\ No newline at end of file
@@ -7,8 +7,18 @@ ZONE_KEY = 'zone'
 CONF_EOL = 'command_eol'
 CONF_THROTTLE_RATE = 'min_time_between_commands'
 CONF_TIMEOUT = 'timeout'
+CONF_DELAY_AFTER_POWER_ON = 'delay_after_power_on'
+CONF_MULTI_SEPARATOR = 'multi-seperator'  # (sic) as spelled in the protocol yaml
 
 DEFAULT_TIMEOUT = 1.0
 FIVE_MINUTES = 300
 
+DEFAULT_GATEWAY_PORT = 4999
+
+# upper bound on commands packed into a single write (protocols with a multi-command separator)
+MAX_COMMANDS_PER_WRITE = 8
+
+# commands ending with this expect a reply from the device
+QUERY_SUFFIX = '?'
+
 ASCII='ascii'
@@ -0,0 +1,256 @@
+"""TCP gateway that shares a single RS232 connection to an Anthem amplifier among many clients
+
+Clients speak the raw Anthem line protocol (e.g. 'P1P1\\n') over TCP. Commands from all clients are
+merged into a single ordered, throttled stream to the amplifier. Status queries (commands ending in '?')
+are answered from a shared cache of recently received status lines where possible, replies are routed
+back to the client that asked, and any unsolicited line from the amplifier is sent to every client.
+
+The library controllers can use the gateway through pyserial's socket:// URLs:
+
+    amp = get_amp_controller('d2v', 'socket://localhost:4999')
+"""
+
+import sys
+import time
+import asyncio
+import logging
+import argparse
+
+from . import _prepare_config
+from .const import ASCII, DEFAULT_GATEWAY_PORT, ZONE_KEY
+from .config import PROTOCOL_CONFIG
+from .protocol_async import get_async_rs232_protocol
+from .transports import TRANSPORT_AUTO, TRANSPORTS
+
+LOG = logging.getLogger(__name__)
+
+# seconds a cached status line may be used to answer a query
+DEFAULT_CACHE_TTL = 5.0
+
+class RS232Gateway(object):
+    """
+    Owns the RS232 protocol for an amplifier and serves any number of TCP clients
+    """
+
+    def __init__(self, serial_client, cache_ttl=DEFAULT_CACHE_TTL):
+        self._serial_client = serial_client
+        self._engine = serial_client.engine
+        self._cache_ttl = cache_ttl
+
+        self._eol = self._engine.frame([ '' ])
+
+        self._clients = set()       # StreamWriter for every connected client
+        self._cache = {}            # (response name, zone) -> (line, time received)
+        self._requests = asyncio.Queue()
+        self._pending = None        # (client, queries, future) for the queries awaiting replies
+        self._held = []             # events received while the query was pending, for its client
+
+        self._server = None
+        self._worker = None
+
+        self._serial_client.add_listener(self._line_received)
+
+    async def start(self, host: str, port: int):
+        self._server = await asyncio.start_server(self._handle_client, host, port)
+        self._worker = asyncio.ensure_future(self._process_requests())
+        LOG.info(f"Anthem gateway listening on {self.address}")
+
+    @property
+    def address(self):
+        """(host, port) the gateway is listening on"""
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+        self._worker.cancel()
+        for client in list(self._clients):
+            client.close()
+
+        self._serial_client.remove_listener(self._line_received)
+        self._serial_client.close()
+
+    async def _handle_client(self, reader, writer):
+        LOG.debug(f"Gateway client connected: {writer.get_extra_info('peername')}")
+        self._clients.add(writer)
+        try:
+            while True:
+                try:
+                    line = await reader.readuntil(self._eol)
+                except asyncio.IncompleteReadError:
+                    break
+
+                request = line.decode(ASCII, errors='replace').strip()
+                if request:
+                    self._requests.put_nowait((writer, request))
+        except ConnectionError:
+            pass
+        finally:
+            self._clients.discard(writer)
+            writer.close()
+            LOG.debug(f"Gateway client disconnected: {writer.get_extra_info('peername')}")
+
+    async def _process_requests(self):
+        """Send requests from all clients to the amplifier one at a time, in the order received"""
+        while True:
+            client, request = await self._requests.get()
+            try:
+                await self._execute(client, request)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                LOG.warning(f"Gateway failed executing {request}: {e}")
+
+    async def _execute(self, client, request: str):
+        # packed requests (Gen1 'P1S5;P1?') are handled per command, but sent to the amplifier as one write
+        commands = [ (command, *self._engine.match_command(command)) for command in self._engine.split(request) ]
+        queries = [ command for command, _, _ in commands if self._engine.is_query(command) ]
+
+        if queries and len(queries) == len(commands):
+            cached = [ self._cached_reply(name, args.get(ZONE_KEY)) for _, name, args in commands ]
+            if all(cached):
+                LOG.debug(f"Answered {request} from cache: {cached}")
+                for line in cached:
+                    self._write(client, line)
+                return
+
+        for command, name, args in commands:
+            if not self._engine.is_query(command):
+                self._invalidate(args.get(ZONE_KEY))
+
+        reply = None
+        if queries:
+            reply = asyncio.get_event_loop().create_future()
+            self._pending = (client, queries, reply)
+
+        # events from the amplifier may arrive at any time, so never discard input before sending
+        await self._serial_client.send(self._engine.frame([ request ]), discard_input=False)
+
+        # Anthem amps ignore RS232 requests for several seconds after powering up
+        if any(name == 'power_on' for _, name, _ in commands):
+            self._serial_client.delay_requests(self._engine.delay_after_power_on)
+
+        if reply:
+            try:
+                await asyncio.wait_for(reply, self._engine.timeout)
+            except asyncio.TimeoutError:
+                LOG.debug(f"Timeout waiting for reply to {request}")
+            finally:
+                self._pending = None
+                for line in self._held:
+                    self._write(client, line)
+                self._held.clear()
+
+    def _line_received(self, line: str):
+        line = line.strip()
+        if not line:
+            return
+
+        name, result = self._engine.match_response(line)
+        if name:
+            self._cache[(name, result.get(ZONE_KEY))] = (line, time.time())
+
+        # unsolicited events (e.g. front panel changes) go to every client
+        recipients = list(self._clients)
+
+        if self._pending:
+            client, queries, reply = self._pending
+            if not reply.done():
+                for query in queries:
+                    if self._engine.is_reply(query, line):
+                        queries.remove(query)
+                        if not queries:
+                            reply.set_result(line)
+                        self._write(client, line)
+                        return
+
+                # the asking client gets events after its reply, so clients reading replies in order see the reply first
+                self._held.append(line)
+                if client in recipients:
+                    recipients.remove(client)
+
+        for client in recipients:
+            self._write(client, line)
+
+    def _cached_reply(self, name: str, zone):
+        """Recent cached line answering the query command (cached by response name, which may differ)"""
+        names = self._engine.reply_names(name)
+        now = time.time()
+        for (response, cached_zone), (line, received) in self._cache.items():
+            if response in names and (zone is None or cached_zone == zone) and now - received <= self._cache_ttl:
+                return line
+        return None
+
+    def _invalidate(self, zone):
+        """Forget cached status for the zone a command changes (or everything if zone is unknown)"""
+        if zone is None:
+            self._cache.clear()
+            return
+        for key in [ key for key in self._cache if key[1] in [ zone, None ] ]:
+            del self._cache[key]
+
+    def _write(self, client, line: str):
+        if client.is_closing():
+            return
+        client.write(line.encode(ASCII) + self._eol)
+
+
+async def start_gateway(amp_series, serial_port_path, loop, host='127.0.0.1', port=DEFAULT_GATEWAY_PORT,
+                        serial_config_overrides = {}, cache_ttl=DEFAULT_CACHE_TTL, transport=TRANSPORT_AUTO):
+    """
+    Open the amplifier serial port and start serving TCP clients
+    :param serial_port_path: serial port, i.e. '/dev/ttyUSB0'
+    :param port: TCP port to listen on (0 picks a free port, see RS232Gateway.address)
+    :param transport: 'serial', 'fd', 'tcp' or 'auto' (see anthemav_serial.transports)
+    :return: running RS232Gateway
+    """
+
+    (config, protocol_type, serial_config) = _prepare_config(amp_series, serial_config_overrides)
+    if not config:
+        return None
+
+    serial_client = await get_async_rs232_protocol(serial_port_path, serial_config, PROTOCOL_CONFIG[protocol_type], loop,
+                                                   transport=transport)
+    gateway = RS232Gateway(serial_client, cache_ttl=cache_ttl)
+    await gateway.start(host, port)
+    return gateway
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Share one Anthem RS232 connection among many TCP clients')
+    parser.add_argument('--series', default='d2v', help='Anthem amplifier series')
+    parser.add_argument('--tty', required=True, help='/dev/tty to use (e.g. /dev/ttyUSB0)')
+    parser.add_argument('--baud', type=int, help='baud rate')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_GATEWAY_PORT, help='TCP port to listen on')
+    parser.add_argument('--cache-ttl', type=float, default=DEFAULT_CACHE_TTL,
+                        help='seconds cached status may answer queries (0 disables)')
+    parser.add_argument('--transport', default=TRANSPORT_AUTO, choices=[ TRANSPORT_AUTO ] + list(TRANSPORTS),
+                        help='how the serial port is driven (fd reads the tty directly, without pyserial-asyncio)')
+    parser.add_argument('--debug', action='store_true', help='enable debug logging')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG if args.debug else logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    config = {}
+    if args.baud:
+        config['baudrate'] = args.baud
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    gateway = loop.run_until_complete(start_gateway(args.series, args.tty, loop, host=args.host, port=args.port,
+                                                    serial_config_overrides=config, cache_ttl=args.cache_ttl,
+                                                    transport=args.transport))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(gateway.close())
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
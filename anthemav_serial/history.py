@@ -0,0 +1,258 @@
+"""Fixed memory, array backed history of zone state for charting and analysis
+
+Each zone keeps a ring of preallocated arrays (one per field) so memory stays constant however
+long the controller runs: timestamps as float64, volume as float32 (NaN when unknown), power/mute
+as a flags byte and the source as a byte index into a table of source codes.
+
+    history = ZoneStateHistory(capacity=100000)
+    history.attach(amp)                       # records every zone state update
+    ...
+    samples = history.range(1, start=time.time() - 3600)
+    hourly = history.downsample(1, interval=3600)
+
+Range queries binary search the timestamps and return array slices, downsampling picks the
+state in effect at each bucket boundary, so neither walks Python objects per sample.
+"""
+
+import csv
+import math
+import time
+import logging
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+from .const import POWER_KEY, MUTE_KEY, VOLUME_KEY, SOURCE_KEY
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_CAPACITY = 10000   # samples kept per zone
+
+TIME_KEY = 'time'
+FLAGS_KEY = 'flags'
+
+# flag bits
+FLAG_POWER = 0x01
+FLAG_MUTE = 0x02
+FLAG_POWER_KNOWN = 0x04
+FLAG_MUTE_KNOWN = 0x08
+
+UNKNOWN_SOURCE = 0xff
+
+def _zeros(typecode: str, capacity: int) -> array:
+    return array(typecode, bytes(array(typecode).itemsize * capacity))
+
+def _empty_samples() -> dict:
+    return { TIME_KEY: array('d'), VOLUME_KEY: array('f'), FLAGS_KEY: array('B'), SOURCE_KEY: array('B') }
+
+
+class _Timeline(object):
+    """Read only sequence view of ring timestamps in chronological order (for bisect)"""
+
+    def __init__(self, ring):
+        self._ring = ring
+
+    def __len__(self):
+        return len(self._ring)
+
+    def __getitem__(self, index):
+        return self._ring._times[self._ring._physical(index)]
+
+
+class ZoneHistory(object):
+    """
+    Ring buffer of state samples for a single zone
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self._times = _zeros('d', capacity)
+        self._volumes = _zeros('f', capacity)
+        self._flags = _zeros('B', capacity)
+        self._sources = _zeros('B', capacity)
+
+        self._next = 0     # physical index written next
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _physical(self, index: int) -> int:
+        """Physical array index of the index'th oldest sample"""
+        if self._count < self.capacity:
+            return index
+        return (self._next + index) % self.capacity
+
+    def append(self, timestamp: float, volume: float, flags: int, source: int):
+        """
+        Append a sample (the oldest sample is dropped when full); a timestamp earlier than the last one
+        (e.g. after the wall clock stepped back) is clamped to it, since range queries binary search the times
+        """
+        if self._count:
+            last = self._times[self._next - 1] # index -1 is the end of the ring when _next wrapped to 0
+            if timestamp < last:
+                LOG.debug(f"Clamping out of order timestamp {timestamp} to {last}")
+                timestamp = last
+
+        i = self._next
+        self._times[i] = timestamp
+        self._volumes[i] = volume
+        self._flags[i] = flags
+        self._sources[i] = source
+
+        self._next = (i + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def _slice(self, data: array, first: int, last: int) -> array:
+        """Chronological samples [first, last) of one field, as a new array"""
+        if first >= last:
+            return data[0:0]
+        start = self._physical(first)
+        end = self._physical(last - 1) + 1
+        if start < end:
+            return data[start:end]
+        return data[start:] + data[:end] # wraps around the end of the ring
+
+    def _bounds(self, start: float = None, end: float = None):
+        timeline = _Timeline(self)
+        first = 0 if start is None else bisect_left(timeline, start)
+        last = self._count if end is None else bisect_right(timeline, end)
+        return (first, last)
+
+    def range(self, start: float = None, end: float = None) -> dict:
+        """
+        Samples with start <= time <= end
+        :return: dictionary of field name -> array ('time', 'volume', 'flags', 'source')
+        """
+        first, last = self._bounds(start, end)
+        return {
+            TIME_KEY:   self._slice(self._times, first, last),
+            VOLUME_KEY: self._slice(self._volumes, first, last),
+            FLAGS_KEY:  self._slice(self._flags, first, last),
+            SOURCE_KEY: self._slice(self._sources, first, last),
+        }
+
+    def downsample(self, interval: float, start: float = None, end: float = None) -> dict:
+        """
+        State in effect at every interval from start to end (sample and hold, since zone state is a step
+        function); buckets before the first sample are skipped
+        :return: dictionary of field name -> array, like range()
+        """
+        result = _empty_samples()
+        if not self._count:
+            return result
+
+        timeline = _Timeline(self)
+        if start is None:
+            start = timeline[0]
+        if end is None:
+            end = timeline[self._count - 1]
+
+        steps = int(math.floor((end - start) / interval)) + 1
+        for step in range(max(0, steps)):
+            at = start + step * interval
+            index = bisect_right(timeline, at) - 1
+            if index < 0:
+                continue
+            i = self._physical(index)
+            result[TIME_KEY].append(at)
+            result[VOLUME_KEY].append(self._volumes[i])
+            result[FLAGS_KEY].append(self._flags[i])
+            result[SOURCE_KEY].append(self._sources[i])
+        return result
+
+
+class ZoneStateHistory(object):
+    """
+    Per zone state history, fed by a controller's state updates
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, clock=time.time):
+        self.capacity = capacity
+        self._clock = clock
+        self._zones = {}
+        self._source_codes = []        # source index -> source code
+        self._source_indexes = {}      # source code -> source index
+
+    def attach(self, amp):
+        """Record every zone state update of an amplifier controller"""
+        amp.add_state_listener(self.record)
+
+    def detach(self, amp):
+        amp.remove_state_listener(self.record)
+
+    @property
+    def zones(self) -> list:
+        return sorted(self._zones)
+
+    def zone(self, zone: int) -> ZoneHistory:
+        history = self._zones.get(zone)
+        if history is None:
+            history = self._zones[zone] = ZoneHistory(self.capacity)
+        return history
+
+    def record(self, zone: int, state: dict, timestamp: float = None):
+        """Append a zone state (as passed to controller state listeners)"""
+        flags = 0
+        power = state.get(POWER_KEY)
+        if power is not None:
+            flags |= FLAG_POWER_KNOWN | (FLAG_POWER if power else 0)
+        mute = state.get(MUTE_KEY)
+        if mute is not None:
+            flags |= FLAG_MUTE_KNOWN | (FLAG_MUTE if mute else 0)
+
+        volume = state.get(VOLUME_KEY)
+        volume = math.nan if volume is None else float(volume)
+
+        if timestamp is None:
+            timestamp = self._clock()
+        self.zone(zone).append(timestamp, volume, flags, self._source_index(state.get(SOURCE_KEY)))
+
+    def _source_index(self, source) -> int:
+        if source is None:
+            return UNKNOWN_SOURCE
+        source = str(source)
+        index = self._source_indexes.get(source)
+        if index is None:
+            if len(self._source_codes) >= UNKNOWN_SOURCE:
+                LOG.warning(f"Too many distinct sources to record source '{source}'")
+                return UNKNOWN_SOURCE
+            index = self._source_indexes[source] = len(self._source_codes)
+            self._source_codes.append(source)
+        return index
+
+    def source_code(self, index: int):
+        """Source code for a recorded source index (None if unknown)"""
+        if index == UNKNOWN_SOURCE or index >= len(self._source_codes):
+            return None
+        return self._source_codes[index]
+
+    def range(self, zone: int, start: float = None, end: float = None) -> dict:
+        """See ZoneHistory.range (empty arrays for a zone never recorded)"""
+        history = self._zones.get(zone)
+        return history.range(start, end) if history else _empty_samples()
+
+    def downsample(self, zone: int, interval: float, start: float = None, end: float = None) -> dict:
+        """See ZoneHistory.downsample (empty arrays for a zone never recorded)"""
+        history = self._zones.get(zone)
+        return history.downsample(interval, start, end) if history else _empty_samples()
+
+    def to_numpy(self, samples: dict) -> dict:
+        """Convert range() or downsample() results to numpy arrays (without copying)"""
+        import numpy # optional dependency, only needed for this export
+        return { name: numpy.frombuffer(data, dtype=data.typecode) for name, data in samples.items() }
+
+    def export_csv(self, zone: int, stream, start: float = None, end: float = None):
+        """Write samples as csv rows of time, power, mute, volume, source"""
+        samples = self.range(zone, start, end)
+        writer = csv.writer(stream)
+        writer.writerow([ TIME_KEY, POWER_KEY, MUTE_KEY, VOLUME_KEY, SOURCE_KEY ])
+        for timestamp, volume, flags, source in zip(samples[TIME_KEY], samples[VOLUME_KEY],
+                                                    samples[FLAGS_KEY], samples[SOURCE_KEY]):
+            writer.writerow([
+                timestamp,
+                bool(flags & FLAG_POWER) if flags & FLAG_POWER_KNOWN else '',
+                bool(flags & FLAG_MUTE) if flags & FLAG_MUTE_KNOWN else '',
+                '' if math.isnan(volume) else volume,
+                self.source_code(source) or '',
+            ])
@@ -0,0 +1,293 @@
+"""I/O free core of the Anthem RS232 protocols
+
+RS232Protocol encodes and frames commands, splits received bytes into lines, does the request
+throttling math and parses replies, without touching a serial port or an event loop. The sync
+(protocol_sync) and asyncio (protocol_async) transports feed it the bytes they read and write the
+bytes it returns, so it can also be exercised entirely in memory.
+"""
+
+import time
+import logging
+
+from string import Formatter
+
+from .const import (ASCII, CONF_EOL, CONF_MULTI_SEPARATOR, CONF_THROTTLE_RATE, CONF_TIMEOUT, CONF_DELAY_AFTER_POWER_ON,
+                    DEFAULT_TIMEOUT, QUERY_SUFFIX, ZONE_KEY, POWER_KEY, MUTE_KEY, VOLUME_KEY, SOURCE_KEY)
+from .config import RS232_RESPONSE_PATTERNS, convert_boolean_fields, match_command
+
+LOG = logging.getLogger(__name__)
+
+CONF_PROTOCOL = 'protocol'
+CONF_BOOLEAN_FIELDS = 'boolean_fields'
+CONF_COMMANDS = 'commands'
+CONF_QUERY_RESPONSES = 'query_responses'
+
+VERSION_RESPONSE = 'query_version'
+ZONE_STATUS = 'zone_status'
+
+# fields tracked as the state of a zone
+ZONE_STATE_KEYS = [ POWER_KEY, MUTE_KEY, VOLUME_KEY, SOURCE_KEY ]
+
+# response fields reported under another name by some protocols (Gen2 'Z1INP3')
+ZONE_STATE_ALIASES = { 'input': SOURCE_KEY }
+
+# per field queries reading the state of a zone on protocols without a zone_status reply (Gen2);
+# power is read first, since a zone that is off reports nothing else
+FIELD_STATUS_QUERIES = [ 'power_status', 'mute_status', 'volume_status', 'source_status' ]
+
+# zone_status replies for zones which are powered off
+ZONE_OFF_RESPONSES = { 'Main Off': 1, 'Zone2 Off': 2, 'Zone3 Off': 3 }
+
+class RS232Protocol(object):
+    """
+    Protocol state machine for one connection: requests in -> bytes out, bytes in -> lines -> parsed replies
+    """
+
+    def __init__(self, communication_config: dict, clock=time.monotonic):
+        """
+        :param communication_config: protocol configuration (from PROTOCOL_CONFIG, optionally with overrides)
+        :param clock: time source used when a 'now' is not passed to the throttling methods
+        """
+        self._config = communication_config
+        self._clock = clock
+
+        self.protocol_type = communication_config[CONF_PROTOCOL]
+        self.timeout = communication_config.get(CONF_TIMEOUT, DEFAULT_TIMEOUT)
+        self.min_time_between_commands = communication_config[CONF_THROTTLE_RATE]
+        self.delay_after_power_on = communication_config.get(CONF_DELAY_AFTER_POWER_ON, 0)
+
+        self._commands = communication_config[CONF_COMMANDS]
+        self._eol = str(communication_config[CONF_EOL])
+        self._eol_bytes = self._eol.encode(ASCII)
+        self._separator = communication_config.get(CONF_MULTI_SEPARATOR)
+        self._boolean_fields = frozenset(communication_config.get(CONF_BOOLEAN_FIELDS) or [])
+        self._response_patterns = list(RS232_RESPONSE_PATTERNS[self.protocol_type].items())
+        self._query_responses = communication_config.get(CONF_QUERY_RESPONSES) or {}
+
+        self._buffer = bytearray()
+        self._last_send = None
+        self._not_before = 0
+
+    #### encoding
+
+    @property
+    def supports_multiple_commands(self) -> bool:
+        """True if several commands may be framed into a single write"""
+        return bool(self._separator)
+
+    def has_command(self, name: str) -> bool:
+        """True if the protocol defines the named command"""
+        return name in self._commands
+
+    def command_fields(self, name: str) -> list:
+        """Names of the arguments a command takes (empty if the command is unknown)"""
+        return list(self.command_format_specs(name))
+
+    def command_format_specs(self, name: str) -> dict:
+        """Format spec of each argument a command takes, e.g. { 'channel': '04' } for 'TAT{channel:04}'"""
+        return { field: spec for _, field, spec, _ in Formatter().parse(self._commands.get(name) or '') if field }
+
+    def format_command(self, name: str, args = {}) -> str:
+        """Return the text for a command (without end of line), or None if the command is unknown"""
+        command = self._commands.get(name)
+        if not command:
+            LOG.error(f"Invalid command format '{name}' for protocol {self.protocol_type}; returning None")
+            return None
+        return command.format(**args)
+
+    def frame(self, commands: list) -> bytes:
+        """Frame one or more command texts as a single write (protocols without a separator allow only one)"""
+        if len(commands) > 1 and not self._separator:
+            raise ValueError(f"Protocol {self.protocol_type} cannot send multiple commands in a single write")
+        return (str(self._separator).join(commands) + self._eol).encode(ASCII)
+
+    def split(self, request: str) -> list:
+        """Split a request text (without end of line) into the command texts framed in it"""
+        if not self._separator:
+            return [ request ]
+        return [ command.strip() for command in request.split(str(self._separator)) if command.strip() ]
+
+    def encode(self, name: str, args = {}) -> bytes:
+        """Return the framed bytes for a single command, or None if the command is unknown"""
+        command = self.format_command(name, args)
+        if command is None:
+            return None
+        return (command + self._eol).encode(ASCII)
+
+    def match_command(self, text: str):
+        """Return (command name, args) for a command text, or (None, {}) if it is not a known command"""
+        return match_command(self.protocol_type, text)
+
+    @staticmethod
+    def is_query(command: str) -> bool:
+        """True if the device replies to the command text"""
+        return command.endswith(QUERY_SUFFIX)
+
+    #### throttling
+
+    def throttle_delay(self, now: float = None) -> float:
+        """Seconds to wait before the next request may be sent"""
+        if self._last_send is None:
+            return 0.0
+        if now is None:
+            now = self._clock()
+        next_send = max(self._last_send + self.min_time_between_commands, self._not_before)
+        return max(0.0, next_send - now)
+
+    def request_sent(self, now: float = None):
+        """Record that a request was written to the device"""
+        self._last_send = self._clock() if now is None else now
+
+    def delay_requests(self, seconds: float, now: float = None):
+        """Throttle future requests for at least the specific seconds since last request"""
+        last_send = self._last_send
+        if last_send is None:
+            last_send = self._clock() if now is None else now
+            self._last_send = last_send
+        self._not_before = max(self._not_before, last_send + seconds)
+
+    #### receiving
+
+    def receive_data(self, data: bytes) -> list:
+        """
+        Feed bytes read from the device
+        :param data: bytes-like object (bytes, bytearray or memoryview); it is copied, not kept
+        :return: list of complete lines received (decoded, without end of line)
+        """
+        buffer = self._buffer
+        buffer += data
+
+        # only search the new data (plus enough of the old for an end of line split across reads)
+        if buffer.find(self._eol_bytes, max(0, len(buffer) - len(data) - len(self._eol_bytes) + 1)) < 0:
+            return []
+
+        *lines, remainder = buffer.split(self._eol_bytes)
+        self._buffer = bytearray(remainder)
+        return [ line.decode(ASCII, errors='replace') for line in lines ]
+
+    @property
+    def buffered(self) -> bytes:
+        """Partial line received so far"""
+        return bytes(self._buffer)
+
+    def reset(self):
+        """Discard any partially received line (e.g. before sending a new request)"""
+        self._buffer.clear()
+
+    #### parsing
+
+    def match_response(self, line: str):
+        """
+        Match a line from the device against the protocol's response patterns
+        :return: (response name, dictionary of fields) or (None, None) if no pattern matches
+        """
+        for name, pattern in self._response_patterns:
+            match = pattern.match(line)
+            if match:
+                return (name, convert_boolean_fields(match.groupdict(), self._boolean_fields))
+        return (None, None)
+
+    def reply_names(self, command_name: str) -> list:
+        """Names of the response patterns answering a query command (defaults to the response of the same name)"""
+        names = self._query_responses.get(command_name)
+        if names is None:
+            names = [ command_name ] if command_name in RS232_RESPONSE_PATTERNS[self.protocol_type] else []
+        return names
+
+    def is_reply(self, query: str, line: str) -> bool:
+        """
+        True if a line received is the reply to a query command text (an expected response for the same zone),
+        rather than an unrelated event; queries without a known response are answered by any unrecognized line
+        """
+        name, args = self.match_command(query)
+        zone = args.get(ZONE_KEY)
+
+        off_zone = ZONE_OFF_RESPONSES.get(line.strip())
+        if off_zone is not None:
+            return name == ZONE_STATUS and str(off_zone) == str(zone)
+
+        response, result = self.match_response(line)
+        names = self.reply_names(name)
+        if response is None:
+            return not names
+        return response in names and (zone is None or str(result.get(ZONE_KEY)) == str(zone))
+
+    def parse(self, line: str) -> dict:
+        """Return a dictionary of the fields in a reply or event, or None if it is not recognized"""
+        name, result = self.match_response(line)
+        if name is None:
+            LOG.debug(f"Found no pattern matching response: {line}")
+        return result
+
+    @property
+    def has_zone_status(self) -> bool:
+        """True if a single zone_status query reports the whole zone state (otherwise see FIELD_STATUS_QUERIES)"""
+        return self.has_command(ZONE_STATUS) and bool(self.reply_names(ZONE_STATUS))
+
+    def field_status_queries(self) -> list:
+        """Names of the per field status queries this protocol defines, in the order to send them"""
+        return [ name for name in FIELD_STATUS_QUERIES if self.has_command(name) ]
+
+    def parse_event(self, line: str) -> dict:
+        """
+        Return the fields of any line from the device (a reply or an unsolicited event), or None if not recognized;
+        zone status lines imply the zone is on and 'Off' lines that it is off
+        """
+        if not line:
+            return None
+
+        zone = ZONE_OFF_RESPONSES.get(line.strip())
+        if zone:
+            return { ZONE_KEY: zone, POWER_KEY: False }
+
+        name, result = self.match_response(line)
+        if name is None:
+            return None
+        for field, alias in ZONE_STATE_ALIASES.items():
+            if field in result:
+                result[alias] = result.pop(field)
+        if name in self.reply_names(ZONE_STATUS):
+            result[POWER_KEY] = True
+        return result
+
+    def parse_zone_status(self, line: str) -> dict:
+        """Return a dictionary containing status details for a zone from its zone_status reply"""
+        if line is None:
+            return None
+
+        zone = ZONE_OFF_RESPONSES.get(line.strip())
+        if zone:
+            return { ZONE_KEY: zone, POWER_KEY: False }
+
+        result = self.parse(line)
+        if result is not None:
+            result[POWER_KEY] = True # power status is implied by a zone_status reply
+        return result
+
+    def zone_state(self, result: dict):
+        """
+        Normalize a parsed reply or event into zone state
+        :return: (zone as int, dictionary of the zone state fields it contains) or (None, None) if not a zone
+        """
+        if not result:
+            return (None, None)
+        try:
+            zone = int(result.get(ZONE_KEY))
+        except (TypeError, ValueError):
+            return (None, None) # e.g. headphones or replies without a zone
+
+        result = { ZONE_STATE_ALIASES.get(key, key): value for key, value in result.items() }
+        state = { key: result[key] for key in ZONE_STATE_KEYS if result.get(key) is not None }
+        if VOLUME_KEY in state:
+            try:
+                state[VOLUME_KEY] = float(state[VOLUME_KEY])
+            except ValueError:
+                del state[VOLUME_KEY]
+        return (zone, state)
+
+    def is_version(self, line: str) -> bool:
+        """True if the line is a reply to query_version"""
+        if not line:
+            return False
+        name, _ = self.match_response(line)
+        return name == VERSION_RESPONSE
@@ -2,17 +2,20 @@
 
 import logging
 
-import time
 import asyncio
 import functools
 from ratelimit import limits
-from serial_asyncio import create_serial_connection
 
-from .const import ASCII, CONF_EOL, CONF_THROTTLE_RATE, CONF_TIMEOUT, DEFAULT_TIMEOUT, FIVE_MINUTES
+from .const import FIVE_MINUTES
+from .protocol import RS232Protocol
+from .transports import TRANSPORT_AUTO, get_transport_opener, reset_buffers
 
 LOG = logging.getLogger(__name__)
 
-async def get_async_rs232_protocol(serial_port_path, serial_config, communication_config, loop):
+async def get_async_rs232_protocol(serial_port_path, serial_config, communication_config, loop, transport=TRANSPORT_AUTO):
+    """
+    :param transport: 'serial', 'fd', 'tcp' or 'auto' (see anthemav_serial.transports)
+    """
 
     # ensure only a single, ordered command is sent to RS232 at a time (non-reentrant lock)
     async def locked_method(method):
@@ -27,7 +30,7 @@ async def get_async_rs232_protocol(serial_port_path, serial_config, communicatio
         @functools.wraps(method)
         async def wrapper(self, *method_args, **method_kwargs):
             try:
-                await asyncio.wait_for(self._connected.wait(), self._timeout)
+                await asyncio.wait_for(self._connected.wait(), self.engine.timeout)
             except:
                 LOG.debug(f"Timeout waiting to send data to {self._serial_port_path}, no connection!")
                 return
@@ -39,15 +42,15 @@ async def get_async_rs232_protocol(serial_port_path, serial_config, communicatio
             super().__init__()
 
             self._serial_port_path = serial_port_path
-            self._config = communication_config
             self._loop = loop
-
-            self._timeout = self._config.get(CONF_TIMEOUT, DEFAULT_TIMEOUT)
-            self._last_send = time.time() - self._timeout
+            self.engine = RS232Protocol(communication_config)
 
             self._transport = None
-            self._connected = asyncio.Event(loop=self._loop)
-            self._q = asyncio.Queue(loop=self._loop)
+            self._connected = asyncio.Event()
+            self._q = asyncio.Queue() # complete lines received but not yet read
+
+            # callbacks invoked with every line received (replies as well as unsolicited events)
+            self._listeners = []
 
             # ensure only a single, ordered command is sent to RS232 at a time (non-reentrant lock)
             #self._lock = asyncio.Lock()
@@ -60,80 +63,82 @@ async def get_async_rs232_protocol(serial_port_path, serial_config, communicatio
             self._connected.set()
 
         def data_received(self, data):
-            LOG.debug(f"Received {self._serial_port_path}: {data}")
-#            asyncio.ensure_future(self._q.put(data), loop=self._loop)
+            if LOG.isEnabledFor(logging.DEBUG):
+                LOG.debug(f"Received {self._serial_port_path}: {bytes(data)}")
+            for line in self.engine.receive_data(data):
+                self._q.put_nowait(line)
+                for listener in self._listeners:
+                    listener(line)
 
         def connection_lost(self, exc):
             LOG.debug(f"Port {self._serial_port_path} closed")
+            self._connected.clear()
 
-        def delay_requests(self, seconds: float):
-            """Throttle future requests for at least the specific seconds since last request"""
-            delta_since_last_send = time.time() - self._last_send
-            self._last_send = (time.time() - delta_since_last_send) + seconds
-
-        # throttle the number of RS232 sends per second to avoid causing timeouts
-        async def _apply_request_throttling(self):
-            delay = None
-            min_time_between_requests = self._config[CONF_THROTTLE_RATE]
-            delta_since_last_send = time.time() - self._last_send
+        def add_listener(self, callback):
+            """Invoke callback(line: str) for every line received from the device"""
+            self._listeners.append(callback)
 
-            if delta_since_last_send < 0:
-                delay = -1 * delta_since_last_send
-            elif delta_since_last_send < min_time_between_requests:
-                delay = max(0, min_time_between_requests - delta_since_last_send)
-                delay = min(delay, min_time_between_requests)
+        def remove_listener(self, callback):
+            if callback in self._listeners:
+                self._listeners.remove(callback)
 
-            if delay > 0:
-                LOG.debug(f"Throttling {delay} seconds before sending request")
-                await asyncio.sleep(delay)
+        def close(self):
+            if self._transport:
+                self._transport.close()
 
+        def delay_requests(self, seconds: float):
+            """Throttle future requests for at least the specific seconds since last request"""
+            self.engine.delay_requests(seconds)
 
         #@ensure_connected
         #@locked_method
-        async def send(self, request: bytes, skip=0):
-            await self._apply_request_throttling()
+        async def send(self, request: bytes, discard_input=True):
+            """
+            :param discard_input: first drop any unread input (data waiting in the port, a partly received line)
+                                  so the next read() is the reply; listeners of unsolicited events (e.g. the
+                                  gateway) pass False so nothing is lost
+            """
+            # throttle the number of RS232 sends per second to avoid causing timeouts
+            delay = self.engine.throttle_delay()
+            if delay > 0:
+                LOG.debug(f"Throttling {delay} seconds before sending request")
+                await asyncio.sleep(delay)
 
             # clear all buffers of any data waiting to be read before sending the request
-            self._transport.serial.reset_output_buffer()
-            self._transport.serial.reset_input_buffer()
+            if discard_input:
+                reset_buffers(self._transport)
+                self.engine.reset()
+
+            # complete lines already went to the listeners, and are stale for read()
             while not self._q.empty():
                 self._q.get_nowait()
 
             # send the request
             LOG.debug(f"Sending {self._serial_port_path}: %s", request)
             self._transport.write(request)
-            self._last_send = time.time()
+            self.engine.request_sent()
 
         #@ensure_connected
         #@locked_method
         async def read(self):
-            data = bytearray()
-            eol = self._config[CONF_EOL].encode(ASCII)
-
-            # read the response
+            """Return the next line received (without end of line), or None on timeout"""
             try:
-                while True:
-                    data += await asyncio.wait_for(self._q.get(), self._timeout, loop=self._loop)
-                    if eol in data:
-                        # only return the first line (ignore all other lines)
-                        result_lines = data.split(eol)
-                        if len(result_lines) > 1 and result_lines[1]:
-                            LOG.debug("Multiple response lines, ignore all but the first: %s", result_lines)
-
-                        result = result_lines[0].decode(ASCII)
-                        LOG.debug(f"Read {self._serial_port_path}: %s", result)
-                        return result
+                result = await asyncio.wait_for(self._q.get(), self.engine.timeout)
+                LOG.debug(f"Read {self._serial_port_path}: %s", result)
+                return result
 
             except asyncio.TimeoutError:
                 # log up to two times within a 5 minute period to avoid saturating the logs
                 @limits(calls=2, period=FIVE_MINUTES)
                 def log_timeout():
-                    LOG.warning(f"Timeout receiving response, ignoring partial data: {data}")
+                    LOG.warning(f"Timeout receiving response, ignoring partial data: {self.engine.buffered}")
                 log_timeout()
                 return None
 
 
     LOG.debug(f"Connecting to {serial_port_path}: {serial_config} {communication_config}")
     factory = functools.partial(RS232AsyncProtocol, serial_port_path, communication_config, loop)
-    _, protocol = await create_serial_connection(loop, factory, serial_port_path, **serial_config)
+    open_transport = get_transport_opener(transport, serial_port_path)
+    _, protocol = await open_transport(loop, factory, serial_port_path, serial_config)
+    await protocol._connected.wait() # some transports schedule, rather than call, connection_made
     return protocol
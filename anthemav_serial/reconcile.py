@@ -0,0 +1,96 @@
+"""Declarative zone state: compute the fewest commands that take zones from their last known state
+to a desired state
+
+    amp.apply_state(2, { 'power': True, 'source': 3, 'volume': -30, 'mute': False })
+    amp.apply_states({ 1: { 'power': True, 'volume': -35 }, 2: { 'power': False } })
+
+Fields missing from (or None in) the desired state are left alone, and fields already in the desired
+state are not sent again. Zones are powered on first (so the power on lockout is only waited out once,
+see anthemav_serial.scene), muted before and unmuted after changing source and volume, and powered off
+last; other fields of a zone being powered off are ignored. The commands for all zones are merged into
+one scene and packed into as few writes as the protocol allows.
+"""
+
+import logging
+
+from .const import MUTE_KEY, VOLUME_KEY, POWER_KEY, SOURCE_KEY, ZONE_KEY
+from .scene import compile_scene
+
+LOG = logging.getLogger(__name__)
+
+STATE_KEYS = [ POWER_KEY, MUTE_KEY, VOLUME_KEY, SOURCE_KEY ]
+
+# volume is set in 0.5 dB steps, so anything closer than half a step is the same volume
+VOLUME_TOLERANCE = 0.25
+
+def expected_state(desired: dict) -> dict:
+    """The fields of a desired state that can be checked (only power for zones being turned off)"""
+    unknown = set(desired) - set(STATE_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown zone state fields {sorted(unknown)}, expected any of {STATE_KEYS}")
+
+    if desired.get(POWER_KEY) is False:
+        return { POWER_KEY: False }
+    return { key: value for key, value in desired.items() if value is not None }
+
+def _same(key: str, known, value) -> bool:
+    if known is None:
+        return False
+    if key == VOLUME_KEY:
+        return abs(float(known) - float(value)) < VOLUME_TOLERANCE
+    if key == SOURCE_KEY:
+        return str(known) == str(value)
+    return bool(known) == bool(value)
+
+def state_differences(current: dict, desired: dict) -> dict:
+    """Return the fields of desired that differ from (or are unknown in) current"""
+    return { key: value for key, value in desired.items()
+             if value is not None and not _same(key, current.get(key), value) }
+
+def plan_commands(current_states: dict, desired_states: dict) -> list:
+    """
+    Order the commands needed to reach the desired states
+    :param current_states: zone -> last known state
+    :param desired_states: zone -> desired state
+    :return: list of scene steps ({ command: args })
+    """
+    power_on = []
+    settings = []
+    power_off = []
+    for zone, desired in desired_states.items():
+        changes = state_differences(current_states.get(zone, {}), expected_state(desired))
+        args = { ZONE_KEY: zone }
+
+        power = changes.get(POWER_KEY)
+        if power is False:
+            power_off.append({ 'power_off': args })
+            continue
+        if power:
+            power_on.append({ 'power_on': args })
+
+        # silence the zone before switching, and only unmute once source and volume are right
+        if changes.get(MUTE_KEY) is True:
+            settings.append({ 'mute_on': args })
+        if SOURCE_KEY in changes:
+            settings.append({ 'source_select': { ZONE_KEY: zone, SOURCE_KEY: changes[SOURCE_KEY] } })
+        if VOLUME_KEY in changes:
+            settings.append({ 'set_volume': { ZONE_KEY: zone, VOLUME_KEY: changes[VOLUME_KEY] } })
+        if changes.get(MUTE_KEY) is False:
+            settings.append({ 'mute_off': args })
+
+    return power_on + settings + power_off
+
+def compile_changes(engine, current_states: dict, desired_states: dict):
+    """
+    Encode the commands needed to reach the desired states
+    :return: (list of SceneWrite to send in order, list of zones that need to change)
+    """
+    zones = [ zone for zone, desired in desired_states.items()
+              if state_differences(current_states.get(zone, {}), expected_state(desired)) ]
+    steps = plan_commands(current_states, desired_states)
+    if not steps:
+        return ([], [])
+
+    writes = compile_scene(engine, 'apply_state', steps)
+    LOG.debug(f"Reaching desired state of zones {zones} takes {len(steps)} commands in {len(writes)} writes")
+    return (writes, zones)
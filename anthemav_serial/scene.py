@@ -0,0 +1,103 @@
+"""Named multi-command scenes compiled ahead of time into the fewest possible writes
+
+Scenes are defined in yaml, either under 'scenes' in a series config or in a separate file:
+
+    scenes:
+      movie_night:
+        - power_on:      { zone: 1 }
+        - source_select: { zone: 1, source: 5 }
+        - set_volume:    { zone: 1, volume: -30 }
+        - mute_off:      { zone: 1 }
+        - power_off:     { zone: 2 }
+
+Each step is a command name from the protocol yaml with its arguments. Compiling validates every
+step against the protocol and packs consecutive commands into a single write on protocols with a
+multi-command separator (Gen1 ';'). Power on commands are moved to the front of the scene (unless an
+earlier step powers the same zone on or off) so the power on lockout is only waited out once.
+"""
+
+import yaml
+import logging
+
+from collections import namedtuple
+
+from .const import ZONE_KEY, MAX_COMMANDS_PER_WRITE
+from .protocol import RS232Protocol
+
+LOG = logging.getLogger(__name__)
+
+CONF_SCENES = 'scenes'
+
+POWER_ON = 'power_on'
+POWER_COMMANDS = [ POWER_ON, 'power_off' ]
+
+# a single framed write, and how long the device ignores requests after it
+SceneWrite = namedtuple('SceneWrite', ['request', 'delay_after'])
+
+def load_scenes(path) -> dict:
+    """Load scene definitions (a 'scenes' mapping of scene name -> steps) from a yaml file"""
+    with open(path, 'r') as stream:
+        config = yaml.safe_load(stream) or {}
+    if isinstance(config, list): # same layout as the series and protocol configs
+        config = config[0]
+    return config.get(CONF_SCENES) or {}
+
+def _parse_step(scene_name: str, step):
+    if isinstance(step, str):
+        return (step, {})
+    if isinstance(step, dict) and len(step) == 1:
+        name, args = next(iter(step.items()))
+        return (name, args or {})
+    raise ValueError(f"Scene '{scene_name}' step {step} must be a command name or a single 'command: args' mapping")
+
+def _power_on_first(steps: list) -> list:
+    """Move power on commands ahead of everything else, unless an earlier step powers the same zone on or off"""
+    leading = []
+    rest = []
+    powered_zones = set()
+    for name, args in steps:
+        zone = args.get(ZONE_KEY)
+        if name == POWER_ON and zone not in powered_zones:
+            leading.append((name, args))
+        else:
+            rest.append((name, args))
+        if name in POWER_COMMANDS:
+            powered_zones.add(zone)
+    return leading + rest
+
+def compile_scene(engine: RS232Protocol, scene_name: str, steps: list) -> list:
+    """
+    Validate and encode a scene
+    :return: list of SceneWrite to send in order
+    """
+    commands = []
+    for name, args in _power_on_first([ _parse_step(scene_name, step) for step in steps ]):
+        try:
+            text = engine.format_command(name, args)
+        except (KeyError, IndexError, ValueError) as e:
+            raise ValueError(f"Scene '{scene_name}' command '{name}' has invalid arguments {args}: {e}")
+        if text is None:
+            raise ValueError(f"Scene '{scene_name}' uses unknown command '{name}' for protocol {engine.protocol_type}")
+        commands.append((name, text))
+
+    max_batch = MAX_COMMANDS_PER_WRITE if engine.supports_multiple_commands else 1
+
+    writes = []
+    batch = []
+    for index, (name, text) in enumerate(commands):
+        batch.append(text)
+
+        # after power on the device ignores requests, so nothing may follow in the same write
+        powering_on = name == POWER_ON
+        next_is_power_on = index + 1 < len(commands) and commands[index + 1][0] == POWER_ON
+        if len(batch) >= max_batch or (powering_on and not next_is_power_on) or index + 1 == len(commands):
+            delay = engine.delay_after_power_on if powering_on else 0
+            writes.append(SceneWrite(engine.frame(batch), delay))
+            batch = []
+
+    LOG.debug(f"Compiled scene '{scene_name}' ({len(commands)} commands) into {len(writes)} writes")
+    return writes
+
+def compile_scenes(engine: RS232Protocol, scenes: dict) -> dict:
+    """Compile a mapping of scene name -> steps into scene name -> list of SceneWrite"""
+    return { name: compile_scene(engine, name, steps) for name, steps in scenes.items() }
@@ -0,0 +1,189 @@
+"""Interchangeable asyncio transports for the RS232 protocol
+
+- 'serial': pyserial-asyncio (the original implementation)
+- 'fd':     opens and configures the tty with pyserial, then registers its file descriptor directly
+            with the event loop and reads into a preallocated buffer (POSIX ttys and ptys; only
+            available on POSIX)
+- 'tcp':    plain asyncio TCP connection for serial-over-IP adapters (socket://host:port or tcp://host:port)
+
+All of them only use the standard event loop APIs (add_reader/add_writer, create_connection), so
+they work with asyncio as well as uvloop. 'auto' picks 'tcp' for socket:// and tcp:// URLs and
+'serial' for everything else.
+"""
+
+import os
+import asyncio
+import logging
+
+from urllib.parse import urlsplit
+
+import serial
+from serial_asyncio import create_serial_connection
+
+LOG = logging.getLogger(__name__)
+
+TRANSPORT_AUTO = 'auto'
+TRANSPORT_SERIAL = 'serial'
+TRANSPORT_FD = 'fd'
+TRANSPORT_TCP = 'tcp'
+
+TCP_SCHEMES = [ 'socket', 'tcp' ]
+
+DEFAULT_READ_BUFFER_SIZE = 4096
+
+class FdTransport(asyncio.Transport):
+    """
+    Minimal non-blocking transport reading and writing a tty file descriptor directly
+    """
+
+    def __init__(self, loop, protocol, port: serial.Serial, read_buffer_size: int = DEFAULT_READ_BUFFER_SIZE):
+        super().__init__()
+        self._loop = loop
+        self._protocol = protocol
+        self._port = port
+        self._fd = port.fileno()
+
+        # received bytes are read into this buffer and passed to the protocol as a memoryview
+        self._read_buffer = bytearray(read_buffer_size)
+        self._read_view = memoryview(self._read_buffer)
+        self._write_buffer = bytearray()
+        self._closing = False
+
+        os.set_blocking(self._fd, False)
+        self._loop.call_soon(self._protocol.connection_made, self)
+        self._loop.call_soon(self._add_reader) # after connection_made, so no data arrives before it
+
+    def _add_reader(self):
+        if self._closing:
+            return # closed (or failed) before the reader was registered
+        self._loop.add_reader(self._fd, self._read_ready)
+
+    def _read_ready(self):
+        try:
+            count = os.readv(self._fd, [ self._read_buffer ])
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            self._fatal_error(exc)
+            return
+
+        if count:
+            self._protocol.data_received(self._read_view[:count])
+        else:
+            self.close() # end of file
+
+    def write(self, data):
+        if self._closing:
+            return
+        if self._write_buffer:
+            self._write_buffer += data
+            return
+
+        try:
+            count = os.write(self._fd, data)
+        except (BlockingIOError, InterruptedError):
+            count = 0
+        except OSError as exc:
+            self._fatal_error(exc)
+            return
+
+        if count < len(data):
+            self._write_buffer += data[count:]
+            self._loop.add_writer(self._fd, self._write_ready)
+
+    def _write_ready(self):
+        try:
+            count = os.write(self._fd, self._write_buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            self._fatal_error(exc)
+            return
+
+        del self._write_buffer[:count]
+        if not self._write_buffer:
+            self._loop.remove_writer(self._fd)
+            if self._closing:
+                self._loop.call_soon(self._call_connection_lost, None)
+
+    def reset_buffers(self):
+        """Discard data waiting in the tty input and output queues"""
+        import termios # POSIX only, like this transport
+        termios.tcflush(self._fd, termios.TCIOFLUSH)
+        if self._write_buffer:
+            self._write_buffer.clear()
+            self._loop.remove_writer(self._fd)
+
+    def get_write_buffer_size(self):
+        return len(self._write_buffer)
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self._loop.remove_reader(self._fd)
+        if not self._write_buffer:
+            self._loop.call_soon(self._call_connection_lost, None)
+
+    def abort(self):
+        self._write_buffer.clear()
+        self._loop.remove_writer(self._fd)
+        self.close()
+
+    def _fatal_error(self, exc):
+        LOG.warning(f"Fatal error on {self._port.port}: {exc}")
+        self._write_buffer.clear()
+        self._loop.remove_writer(self._fd)
+        self._closing = True
+        self._loop.remove_reader(self._fd)
+        self._loop.call_soon(self._call_connection_lost, exc)
+
+    def _call_connection_lost(self, exc):
+        try:
+            self._protocol.connection_lost(exc)
+        finally:
+            self._port.close()
+
+
+async def open_serial_transport(loop, protocol_factory, url, serial_config):
+    return await create_serial_connection(loop, protocol_factory, url, **serial_config)
+
+async def open_fd_transport(loop, protocol_factory, url, serial_config):
+    port = serial.serial_for_url(url, **serial_config) # opens the tty and applies baudrate, parity, etc
+    protocol = protocol_factory()
+    return (FdTransport(loop, protocol, port), protocol)
+
+async def open_tcp_transport(loop, protocol_factory, url, serial_config):
+    address = urlsplit(url)
+    return await loop.create_connection(protocol_factory, address.hostname, address.port)
+
+TRANSPORTS = {
+    TRANSPORT_SERIAL: open_serial_transport,
+    TRANSPORT_TCP: open_tcp_transport,
+}
+if os.name == 'posix':
+    TRANSPORTS[TRANSPORT_FD] = open_fd_transport
+
+def get_transport_opener(transport: str, url: str):
+    """Return the coroutine function opening the named transport (see TRANSPORTS) for a port url"""
+    if transport == TRANSPORT_AUTO:
+        transport = TRANSPORT_TCP if urlsplit(url).scheme in TCP_SCHEMES else TRANSPORT_SERIAL
+
+    opener = TRANSPORTS.get(transport)
+    if not opener:
+        raise ValueError(f"Unknown transport '{transport}', expected one of {[ TRANSPORT_AUTO ] + list(TRANSPORTS)}")
+    return opener
+
+def reset_buffers(transport):
+    """Discard any data queued in the underlying port (nothing to do for TCP connections)"""
+    if isinstance(transport, FdTransport):
+        transport.reset_buffers()
+        return
+
+    port = getattr(transport, 'serial', None) # pyserial-asyncio
+    if port:
+        port.reset_output_buffer()
+        port.reset_input_buffer()
@@ -0,0 +1,327 @@
+"""Tuner band scanning with a persistent station and preset cache
+
+Scanning tunes to the bottom of a band and then repeatedly seeks up, waits for the seek to settle
+and reads back the frequency until the tuner wraps around. Frequencies are parsed with the protocol's
+tuner_fm/tuner_am response patterns.
+
+Discovered stations and preset frequencies are saved in a local json cache per amplifier (series and
+port), so station lists and preset recalls are available later without scanning again:
+
+    tuner = Tuner(amp)
+    stations = tuner.scan('fm')            # scans once, then served from the cache
+    tuner.scan_presets('fm', [ 1, 2, 3 ], bank=1)    # Gen1 presets are in banks, Gen2 has no bank
+    frequency = tuner.recall_preset('fm', 2, bank=1)
+
+The scans are written as I/O free plans (generators yielding TunerRequests and receiving the reply
+lines), shared by the Tuner (sync) and AsyncTuner drivers.
+"""
+
+import os
+import json
+import logging
+
+from collections import namedtuple
+from urllib.parse import quote
+
+import serial
+
+LOG = logging.getLogger(__name__)
+
+FM = 'fm'
+AM = 'am'
+
+CHANNEL_KEY = 'channel'
+BANK_KEY = 'bank'
+PRESET_KEY = 'preset'
+
+# band limits and step from the protocol documentation: FM 87.5 to 107.9 MHz in 0.1 MHz steps,
+# AM 540 to 1600 kHz in 10 kHz steps
+Band = namedtuple('Band', [ 'start', 'end', 'step', 'tune', 'preset', 'queries', 'response', 'field' ])
+BANDS = {
+    FM: Band(87.5, 107.9, 0.1, 'fm_tune', 'fm_preset', [ 'fm_status', 'tuner_frequeny' ], 'tuner_fm', 'fm_freq'),
+    AM: Band(540, 1600, 10, 'am_tune', 'am_preset', [ 'am_status', 'tuner_frequeny' ], 'tuner_am', 'am_freq'),
+}
+
+SEEK_UP = 'seek_up'
+
+# seconds for a seek to find the next station before the frequency is read back; reading in the
+# same write as the seek (Gen1 'T+;TT?') returns the frequency before the seek has finished
+DEFAULT_SEEK_SETTLE = 2.0
+
+# a seek that only ever moved one channel for at least this many stations is stepping, not seeking
+MIN_STEPS_TO_DETECT_STEPPING = 10
+
+# a single framed write, whether a reply is read and how long to wait before the next request
+TunerRequest = namedtuple('TunerRequest', [ 'request', 'expects_reply', 'delay_after' ])
+
+def default_cache_path(series: str = None, port: str = None) -> str:
+    """Cache file for one amplifier, so different amplifiers never overwrite each other's stations and presets"""
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    filename = 'tuner.json'
+    if series or port:
+        filename = f"tuner-{quote(f'{series}-{port}', safe='')}.json"
+    return os.path.join(cache_dir, 'anthemav_serial', filename)
+
+def _band(engine, band: str) -> Band:
+    config = BANDS.get(band)
+    if not config or not engine.has_command(config.tune):
+        raise ValueError(f"Band '{band}' is not supported by protocol {engine.protocol_type}")
+    return config
+
+def _query_command(engine, band: Band) -> str:
+    for name in band.queries:
+        if engine.has_command(name):
+            return engine.format_command(name)
+    raise ValueError(f"Protocol {engine.protocol_type} cannot query the tuner frequency")
+
+def _channel(band: str, frequency):
+    """Format a frequency as the protocol's tune channel argument"""
+    if band == FM:
+        return f"{float(frequency):.1f}"
+    return int(frequency)
+
+def _preset_args(engine, band: Band, preset, bank=None) -> dict:
+    """Arguments of the band's preset command, checking that a bank is passed exactly when it takes one"""
+    args = { PRESET_KEY: preset }
+    if BANK_KEY in engine.command_fields(band.preset):
+        if bank is None:
+            raise ValueError(f"Protocol {engine.protocol_type} requires a preset bank for {band.preset}")
+        args[BANK_KEY] = bank
+    elif bank is not None:
+        raise ValueError(f"Protocol {engine.protocol_type} has no preset banks for {band.preset}")
+    return args
+
+def _preset_key(preset, bank=None) -> str:
+    return f"{bank}-{preset}" if bank is not None else str(preset)
+
+def parse_frequency(engine, band: str, line: str):
+    """Return the frequency (MHz for FM, kHz for AM) reported in a tuner reply, or None"""
+    config = BANDS[band]
+    if not line:
+        return None
+    name, result = engine.match_response(line)
+    if name != config.response:
+        return None
+    value = result[config.field]
+    return round(float(value), 1) if band == FM else int(value)
+
+def tune_plan(engine, band: str, frequency):
+    """Plan to tune directly to a frequency and read it back"""
+    config = _band(engine, band)
+    if not config.start <= frequency <= config.end:
+        raise ValueError(f"Frequency {frequency} is outside the {band} band ({config.start} to {config.end})")
+
+    tune = engine.format_command(config.tune, { CHANNEL_KEY: _channel(band, frequency) })
+    reply = yield from _send_and_query(engine, config, [ tune ])
+    return parse_frequency(engine, band, reply)
+
+def _is_one_step(band: Band, low, high) -> bool:
+    return abs((high - low) - band.step) < band.step / 2
+
+def scan_plan(engine, band: str, settle: float = DEFAULT_SEEK_SETTLE):
+    """
+    Plan to find every station in a band by seeking up from the bottom until the tuner wraps around
+    :param settle: seconds to let a seek finish before reading the frequency; 0 reads it back in the same
+                   write as the seek where the protocol allows, which only suits tuners that reply after seeking
+    :return: list of station frequencies, in ascending order
+    :raises ValueError: if a frequency could not be read back (e.g. a timeout), rather than returning a partial list
+    """
+    config = _band(engine, band)
+
+    # Gen1 defines seek_up and tuner_up as the same 'T+', so whether it seeks to the next station or
+    # steps to the next channel is up to the unit; stepping is detected below instead of listing every
+    # channel as a station
+    seek = engine.format_command(SEEK_UP)
+    tune = engine.format_command(config.tune, { CHANNEL_KEY: _channel(band, config.start) })
+    yield TunerRequest(engine.frame([ tune ]), False, 0)
+
+    stations = []
+    max_seeks = int(round((config.end - config.start) / config.step)) + 1
+    for _ in range(max_seeks):
+        if settle:
+            yield TunerRequest(engine.frame([ seek ]), False, settle)
+            reply = yield from _send_and_query(engine, config, [])
+        else:
+            reply = yield from _send_and_query(engine, config, [ seek ])
+
+        frequency = parse_frequency(engine, band, reply)
+        if frequency is None:
+            # an incomplete scan must not end up cached as the band's station list
+            raise ValueError(f"No {band} tuner frequency in reply {reply} after {len(stations)} stations; scan aborted")
+        if stations and frequency <= stations[-1]:
+            break # wrapped around to the bottom of the band (or the frequency did not change)
+        stations.append(frequency)
+
+    if len(stations) >= MIN_STEPS_TO_DETECT_STEPPING and \
+            all(_is_one_step(config, low, high) for low, high in zip(stations, stations[1:])):
+        raise ValueError(f"Seeking on protocol {engine.protocol_type} stepped through every {band} channel "
+                         f"instead of stopping at stations")
+
+    LOG.info(f"Found {len(stations)} {band} stations: {stations}")
+    return stations
+
+def preset_plan(engine, band: str, preset, bank=None):
+    """Plan to recall a preset and read back its frequency"""
+    config = _band(engine, band)
+    recall = engine.format_command(config.preset, _preset_args(engine, config, preset, bank))
+    reply = yield from _send_and_query(engine, config, [ recall ])
+    return parse_frequency(engine, band, reply)
+
+def _send_and_query(engine, band: Band, commands: list):
+    """Send commands followed by a frequency query, in one write when the protocol allows"""
+    query = _query_command(engine, band)
+    if commands and not engine.supports_multiple_commands:
+        yield TunerRequest(engine.frame(commands), False, 0)
+        commands = []
+    reply = yield TunerRequest(engine.frame(commands + [ query ]), True, 0)
+    return reply
+
+
+class TunerCache(object):
+    """
+    Station lists and preset frequencies, persisted as json
+    """
+
+    def __init__(self, path: str = None):
+        self._path = path or default_cache_path()
+        self._data = { 'stations': {}, 'presets': {} }
+        try:
+            with open(self._path, 'r') as stream:
+                self._data.update(json.load(stream))
+        except FileNotFoundError:
+            pass
+        except (ValueError, OSError) as e:
+            LOG.warning(f"Ignoring unreadable tuner cache {self._path}: {e}")
+
+    def stations(self, band: str) -> list:
+        return self._data['stations'].get(band)
+
+    def set_stations(self, band: str, stations: list):
+        self._data['stations'][band] = stations
+        self.save()
+
+    def preset(self, band: str, key: str):
+        return self._data['presets'].get(band, {}).get(key)
+
+    def set_preset(self, band: str, key: str, frequency):
+        self._data['presets'].setdefault(band, {})[key] = frequency
+        self.save()
+
+    def presets(self, band: str) -> dict:
+        return dict(self._data['presets'].get(band, {}))
+
+    def save(self):
+        os.makedirs(os.path.dirname(self._path) or '.', exist_ok=True)
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'w') as stream:
+            json.dump(self._data, stream, indent=2, sort_keys=True)
+        os.replace(temp_path, self._path)
+
+
+class Tuner(object):
+    """
+    Tuner control for a synchronous amplifier controller (see get_amp_controller)
+    """
+
+    def __init__(self, amp, cache: TunerCache = None):
+        self._amp = amp
+        self._engine = amp.engine
+        self.cache = cache or TunerCache(default_cache_path(amp.series, amp.serial_port_path))
+
+    def _run(self, plan):
+        try:
+            step = next(plan)
+            while True:
+                reply = None
+                try:
+                    reply = self._amp.send_request(step.request, wait_for_reply=step.expects_reply,
+                                                   delay_after=step.delay_after)
+                except serial.SerialTimeoutException as e:
+                    LOG.debug(f"No tuner reply: {e}")
+                step = plan.send(reply)
+        except StopIteration as done:
+            return done.value
+
+    def stations(self, band: str = FM) -> list:
+        """Return the cached station list for the band (None if it has never been scanned)"""
+        return self.cache.stations(band)
+
+    def scan(self, band: str = FM, refresh=False, settle: float = DEFAULT_SEEK_SETTLE) -> list:
+        """Return all stations in the band, scanning only if not cached (or refresh is requested)"""
+        stations = self.cache.stations(band)
+        if stations is None or refresh:
+            stations = self._run(scan_plan(self._engine, band, settle))
+            self.cache.set_stations(band, stations)
+        return stations
+
+    def tune(self, band: str, frequency):
+        """Tune to a frequency (MHz for FM, kHz for AM) and return the frequency reported by the tuner"""
+        return self._run(tune_plan(self._engine, band, frequency))
+
+    def scan_presets(self, band: str, presets: list, bank=None) -> dict:
+        """Recall each preset, caching and returning its frequency keyed by preset"""
+        found = {}
+        for preset in presets:
+            found[_preset_key(preset, bank)] = self.recall_preset(band, preset, bank, refresh=True)
+        return found
+
+    def recall_preset(self, band: str, preset, bank=None, refresh=False):
+        """Recall a preset; the frequency is read back only if it is not already cached"""
+        key = _preset_key(preset, bank)
+        frequency = self.cache.preset(band, key)
+        if frequency is not None and not refresh:
+            config = _band(self._engine, band)
+            self._amp.send_command(config.preset, _preset_args(self._engine, config, preset, bank),
+                                   wait_for_reply=False)
+            return frequency
+
+        frequency = self._run(preset_plan(self._engine, band, preset, bank))
+        if frequency is not None:
+            self.cache.set_preset(band, key, frequency)
+        return frequency
+
+
+class AsyncTuner(Tuner):
+    """
+    Tuner control for an asyncio amplifier controller (see get_async_amp_controller)
+    """
+
+    async def _run(self, plan):
+        try:
+            step = next(plan)
+            while True:
+                reply = await self._amp.send_request(step.request, wait_for_reply=step.expects_reply,
+                                                     delay_after=step.delay_after)
+                step = plan.send(reply)
+        except StopIteration as done:
+            return done.value
+
+    async def scan(self, band: str = FM, refresh=False, settle: float = DEFAULT_SEEK_SETTLE) -> list:
+        stations = self.cache.stations(band)
+        if stations is None or refresh:
+            stations = await self._run(scan_plan(self._engine, band, settle))
+            self.cache.set_stations(band, stations)
+        return stations
+
+    async def tune(self, band: str, frequency):
+        return await self._run(tune_plan(self._engine, band, frequency))
+
+    async def scan_presets(self, band: str, presets: list, bank=None) -> dict:
+        found = {}
+        for preset in presets:
+            found[_preset_key(preset, bank)] = await self.recall_preset(band, preset, bank, refresh=True)
+        return found
+
+    async def recall_preset(self, band: str, preset, bank=None, refresh=False):
+        key = _preset_key(preset, bank)
+        frequency = self.cache.preset(band, key)
+        if frequency is not None and not refresh:
+            config = _band(self._engine, band)
+            await self._amp.send_command(config.preset, _preset_args(self._engine, config, preset, bank),
+                                         wait_for_reply=False)
+            return frequency
+
+        frequency = await self._run(preset_plan(self._engine, band, preset, bank))
+        if frequency is not None:
+            self.cache.set_preset(band, key, frequency)
+        return frequency
@@ -49,6 +49,12 @@ setup(name='anthemav_serial',
       packages=['anthemav_serial'],
       install_requires=['pyserial>=3.4','pyserial-asyncio>=0.4'],
       include_package_data=True,
+      entry_points={
+          'console_scripts': [
+              'anthemav-serial=anthemav_serial.cli:main',
+              'anthemav-serial-gateway=anthemav_serial.gateway:main',
+          ],
+      },
       classifiers=['Development Status :: 4 - Beta',
                    'License :: OSI Approved :: MIT License',
                    'Programming Language :: Python :: 3' ],
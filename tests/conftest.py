@@ -0,0 +1,56 @@
+"""Shared fixtures: a fake Gen1 amplifier on a pty"""
+
+import os
+import threading
+
+import pytest
+
+# replies of the fake amplifier; zone 1 status is preceded by an unsolicited zone 3 event
+REPLIES = {
+    b'P1?':   b'P3M1\nP1S5V-30.0M0\n',
+    b'P2?':   b'Zone2 Off\n',
+    b'P1VM?': b'P1VM-30.0\n',
+}
+
+class FakeAmp(object):
+
+    def __init__(self):
+        import tty # POSIX only, like the tests using this fixture
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.received = []
+        self.replies = dict(REPLIES)
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        buffer = b''
+        while True:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                return
+            buffer += data
+            while b'\n' in buffer:
+                line, buffer = buffer.split(b'\n', 1)
+                self.received.append(line)
+                for command in line.split(b';'): # packed Gen1 writes are answered command by command
+                    if command in self.replies:
+                        os.write(self.master, self.replies[command])
+
+    def send_event(self, line: bytes):
+        os.write(self.master, line + b'\n')
+
+    def send_partial(self, data: bytes):
+        os.write(self.master, data)
+
+    def close(self):
+        os.close(self.slave)
+        os.close(self.master)
+
+
+@pytest.fixture
+def amp():
+    fake = FakeAmp()
+    yield fake
+    fake.close()
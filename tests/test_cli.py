@@ -0,0 +1,77 @@
+"""Tests for the streaming batch command CLI"""
+
+import io
+import os
+import json
+import queue
+
+import pytest
+
+from anthemav_serial import _prepare_config
+from anthemav_serial.cli import BatchRunner, _read_input, parse_command_line
+from anthemav_serial.config import PROTOCOL_CONFIG
+from anthemav_serial.const import CONF_THROTTLE_RATE, MAX_COMMANDS_PER_WRITE
+from anthemav_serial.protocol import RS232Protocol
+from anthemav_serial.protocol_sync import get_sync_rs232_protocol
+
+GEN1 = RS232Protocol(PROTOCOL_CONFIG['anthem_rs232_gen1'])
+GEN2 = RS232Protocol(PROTOCOL_CONFIG['anthem_rs232_gen2'])
+
+def run(engine, text: str, serial_client=None):
+    """Run the lines of text through a BatchRunner, returning (errors, printed results)"""
+    commands = queue.Queue()
+    _read_input(io.StringIO(text), commands) # all input is waiting, so the runner batches as much as it may
+    output = io.StringIO()
+    errors = BatchRunner(engine, serial_client, output=output).run(commands)
+    return errors, [ json.loads(line) for line in output.getvalue().splitlines() ]
+
+def test_parse_command_line():
+    assert parse_command_line('set_volume zone=1 volume=-30') == ('set_volume', { 'zone': '1', 'volume': '-30' })
+    assert parse_command_line("display_message zone=1 row=1 message='Hi there' # comment") == \
+        ('display_message', { 'zone': '1', 'row': '1', 'message': 'Hi there' })
+    assert parse_command_line('  # only a comment') is None
+    with pytest.raises(ValueError, match='key=value'):
+        parse_command_line('power_on 1')
+
+def test_zero_padding_kept_unless_formatted_as_number():
+    _, results = run(GEN1, 'rename_source source=1 name=007\nam_tune channel=540\n')
+    assert results == [ { 'commands': [ 'rename_source', 'am_tune' ], 'write': 'SN1007;TAT0540\n' } ]
+
+    _, results = run(GEN2, 'set_anthem_logic_mode mode=01\n')
+    assert results == [ { 'commands': [ 'set_anthem_logic_mode' ], 'write': 'Z1ALM01\n' } ]
+
+def test_batch_ends_at_query_and_power_on():
+    errors, results = run(GEN1, 'set_volume zone=1 volume=-30\nzone_status zone=1\nmute_on zone=2\n'
+                                'power_on zone=3\nsource_select zone=3 source=2\n')
+    assert errors == 0
+    assert [ result['write'] for result in results ] == [ 'P1VM-30;P1?\n', 'P2M1;P3P1\n', 'P3S2\n' ]
+
+def test_batch_ends_at_max_commands_per_write():
+    _, results = run(GEN1, 'mute_toggle zone=1\n' * (MAX_COMMANDS_PER_WRITE + 1))
+    assert [ len(result['commands']) for result in results ] == [ MAX_COMMANDS_PER_WRITE, 1 ]
+
+    _, results = run(GEN2, 'mute_on zone=1\nmute_on zone=2\n')
+    assert [ result['write'] for result in results ] == [ 'Z1MUT1\n', 'Z2MUT1\n' ]
+
+def test_invalid_commands_counted_and_skipped():
+    errors, results = run(GEN1, 'no_such_command\nset_volume zone=1\nmute_on zone=1\n')
+    assert errors == 2
+    assert results == [ { 'commands': [ 'mute_on' ], 'write': 'P1M1\n' } ]
+
+@pytest.mark.skipif(not hasattr(os, 'openpty'), reason='needs a pty')
+def test_run_against_amplifier(amp):
+    (_, protocol_type, serial_config) = _prepare_config('d2v', {})
+    communication_config = dict(PROTOCOL_CONFIG[protocol_type], **{ CONF_THROTTLE_RATE: 0.01 })
+    serial_client = get_sync_rs232_protocol(amp.port, serial_config, communication_config)
+
+    errors, results = run(serial_client.engine, 'mute_off zone=1\nzone_status zone=1\nzone_status zone=2\n', serial_client)
+    serial_client.close()
+
+    assert errors == 0
+    assert amp.received == [ b'P1M0;P1?', b'P2?' ]
+    assert len(results) == 3
+    assert results[0] == { 'event': 'P3M1', 'result': { 'zone': '3', 'mute': True } } # sent before the reply
+    assert results[1]['response'] == 'P1S5V-30.0M0'
+    assert (results[1]['result']['zone'], results[1]['result']['power']) == ('1', True)
+    assert results[2] == { 'command': 'zone_status', 'args': { 'zone': '2' }, 'response': 'Zone2 Off',
+                           'result': { 'zone': 2, 'power': False } }
@@ -0,0 +1,30 @@
+"""Controllers talking directly to a fake Gen1 amplifier on a pty"""
+
+import os
+import asyncio
+
+import pytest
+
+from anthemav_serial import get_amp_controller, get_async_amp_controller
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'openpty'), reason='needs a pty')
+
+def test_sync_zone_status_skips_events_before_the_reply(amp):
+    controller = get_amp_controller('d2v', amp.port)
+    status = controller.zone_status(1) # the fake amplifier sends 'P3M1' before the zone 1 reply
+    controller._serial_client.close()
+
+    assert status['zone'] == '1' and status['source'] == '5' and status['power'] is True
+    assert controller._zone_state == { 3: { 'mute': True }, 1: { 'power': True, 'mute': False, 'volume': -30.0, 'source': '5' } }
+
+def test_async_zone_status_skips_events_before_the_reply(amp):
+    async def run():
+        controller = await get_async_amp_controller('d2v', amp.port, asyncio.get_running_loop())
+        status = await controller.zone_status(1)
+        controller._serial_client.close()
+        return controller, status
+
+    controller, status = asyncio.run(run())
+    assert status['zone'] == '1' and status['source'] == '5' and status['power'] is True
+    assert controller._zone_state[3] == { 'mute': True }
+    assert controller._zone_state[1]['power'] is True
@@ -0,0 +1,144 @@
+"""Gateway round trips on localhost, against a fake Gen1 amplifier on a pty"""
+
+import os
+import asyncio
+
+import pytest
+
+from anthemav_serial import get_amp_controller
+from anthemav_serial.gateway import start_gateway
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'openpty'), reason='needs a pty')
+
+async def _read_lines(reader, count):
+    return [ (await asyncio.wait_for(reader.readline(), 2)).strip() for _ in range(count) ]
+
+def test_reply_routed_to_asking_client_and_event_to_all(amp):
+    async def run():
+        loop = asyncio.get_running_loop()
+        gateway = await start_gateway('d2v', amp.port, loop, port=0, cache_ttl=0)
+        host, port = gateway.address
+        asker_reader, asker = await asyncio.open_connection(host, port)
+        other_reader, other = await asyncio.open_connection(host, port)
+
+        asker.write(b'P1?\n')
+        asker_lines = await _read_lines(asker_reader, 2)
+        other_lines = await _read_lines(other_reader, 1)
+
+        asker.close()
+        other.close()
+        await gateway.close()
+        return asker_lines, other_lines
+
+    asker_lines, other_lines = asyncio.run(run())
+    assert asker_lines == [ b'P1S5V-30.0M0', b'P3M1' ]  # reply first, then the event held during the query
+    assert other_lines == [ b'P3M1' ]
+
+def test_sync_controller_through_gateway(amp):
+    async def run():
+        loop = asyncio.get_running_loop()
+        gateway = await start_gateway('d2v', amp.port, loop, port=0, cache_ttl=0)
+        host, port = gateway.address
+
+        controller = await loop.run_in_executor(None, get_amp_controller, 'd2v', f"socket://{host}:{port}")
+        zone1 = await loop.run_in_executor(None, controller.zone_status, 1)
+        zone2 = await loop.run_in_executor(None, controller.zone_status, 2)
+        await gateway.close()
+        return zone1, zone2
+
+    zone1, zone2 = asyncio.run(run())
+    assert zone1['zone'] == '1' and zone1['source'] == '5' and zone1['power'] is True
+    assert zone2 == { 'zone': 2, 'power': False }
+
+def test_events_between_queries_reach_every_client(amp):
+    async def run():
+        loop = asyncio.get_running_loop()
+        gateway = await start_gateway('d2v', amp.port, loop, port=0, cache_ttl=0)
+        connections = [ await asyncio.open_connection(*gateway.address) for _ in range(2) ]
+        await asyncio.sleep(0.1)
+
+        amp.send_event(b'P2M1')
+        lines = [ await _read_lines(reader, 1) for reader, _ in connections ]
+        await gateway.close()
+        return lines
+
+    assert asyncio.run(run()) == [ [ b'P2M1' ], [ b'P2M1' ] ]
+
+def test_event_split_around_a_command_is_not_discarded(amp):
+    amp.replies[b'P1M1'] = b'1\n' # completes the 'P2M' sent before the command
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        gateway = await start_gateway('d2v', amp.port, loop, port=0, cache_ttl=0)
+        reader, writer = await asyncio.open_connection(*gateway.address)
+
+        amp.send_partial(b'P2M')
+        await asyncio.sleep(0.1)
+        writer.write(b'P1M1\n')
+        lines = await _read_lines(reader, 1)
+        await gateway.close()
+        return lines
+
+    assert asyncio.run(run()) == [ b'P2M1' ]
+
+
+def test_queries_answered_from_cache(amp):
+    async def run():
+        loop = asyncio.get_running_loop()
+        gateway = await start_gateway('d2v', amp.port, loop, port=0)
+        reader, writer = await asyncio.open_connection(*gateway.address)
+
+        replies = []
+        for _ in range(2):
+            writer.write(b'P1VM?\n')
+            replies += await _read_lines(reader, 1)
+
+        writer.close()
+        await gateway.close()
+        return replies
+
+    replies = asyncio.run(run())
+    assert replies == [ b'P1VM-30.0', b'P1VM-30.0' ]
+    assert amp.received.count(b'P1VM?') == 1
+
+def test_packed_write_answered_and_invalidates_every_zone(amp):
+    async def run():
+        loop = asyncio.get_running_loop()
+        gateway = await start_gateway('d2v', amp.port, loop, port=0)
+        reader, writer = await asyncio.open_connection(*gateway.address)
+
+        writer.write(b'P1VM?\n')
+        lines = await _read_lines(reader, 1)
+
+        amp.replies[b'P1VM?'] = b'P1VM-20.0\n'
+        writer.write(b'P2M1;P1VM-20\n') # changes zone 1 as well, so its cached volume is stale
+        writer.write(b'P1VM?\n')
+        lines += await _read_lines(reader, 1)
+
+        started = loop.time()
+        writer.write(b'P1S5;P1?\n')
+        lines += await _read_lines(reader, 2)
+        elapsed = loop.time() - started
+
+        writer.close()
+        await gateway.close()
+        return lines, elapsed
+
+    lines, elapsed = asyncio.run(run())
+    assert lines == [ b'P1VM-30.0', b'P1VM-20.0', b'P1S5V-30.0M0', b'P3M1' ]
+    assert elapsed < 1.0 # the packed query's reply is recognized rather than waiting out the timeout
+
+
+def test_reply_names_map_queries_to_responses():
+    from anthemav_serial.config import PROTOCOL_CONFIG
+    from anthemav_serial.protocol import RS232Protocol
+
+    gen1 = RS232Protocol(PROTOCOL_CONFIG['anthem_rs232_gen1'])
+    assert gen1.match_response('P1VM-30.0')[0] in gen1.reply_names('volume_status')
+    assert gen1.is_reply('P2?', 'Zone2 Off') and not gen1.is_reply('P1?', 'Zone2 Off')
+    assert not gen1.is_reply('P1?', 'P3M1')
+
+    gen2 = RS232Protocol(PROTOCOL_CONFIG['anthem_rs232_gen2'])
+    assert gen2.match_response('Z1INP3')[0] in gen2.reply_names('source_status')
+    assert gen2.match_response('T1FMS101.1')[0] in gen2.reply_names('fm_status')
+    assert gen2.is_reply('Z2INP?', 'Z2INP3') and not gen2.is_reply('Z2INP?', 'Z1INP3')
@@ -0,0 +1,65 @@
+"""Tests for the array backed zone state history"""
+
+import io
+import math
+
+from anthemav_serial.history import ZoneHistory, ZoneStateHistory, FLAG_POWER, FLAG_POWER_KNOWN
+
+def _fill(history, times):
+    for timestamp in times:
+        history.append(timestamp, -float(timestamp), 0, 0)
+
+def test_ring_drops_oldest_when_full():
+    history = ZoneHistory(capacity=4)
+    _fill(history, range(1, 7))
+    assert len(history) == 4
+    assert list(history.range()['time']) == [ 3, 4, 5, 6 ]
+
+def test_range_slices_across_the_end_of_the_ring():
+    history = ZoneHistory(capacity=5)
+    _fill(history, range(1, 9)) # physical order is now 6, 7, 8, 4, 5
+
+    samples = history.range(start=4, end=7)
+    assert list(samples['time']) == [ 4, 5, 6, 7 ]
+    assert list(samples['volume']) == [ -4, -5, -6, -7 ]
+    assert list(history.range(start=5.5, end=5.9)['time']) == []
+    assert list(history.range(start=8)['time']) == [ 8 ]
+
+def test_downsample_holds_the_state_in_effect():
+    history = ZoneHistory(capacity=5)
+    _fill(history, [ 10, 20, 35, 40, 41, 42 ]) # 10 dropped
+
+    samples = history.downsample(10, start=15, end=45)
+    assert list(samples['time']) == [ 25, 35, 45 ]     # nothing before 20, so 15 is skipped
+    assert list(samples['volume']) == [ -20, -35, -42 ]
+
+def test_out_of_order_timestamps_are_clamped():
+    history = ZoneHistory(capacity=3)
+    _fill(history, [ 10, 20, 15 ])
+    _fill(history, [ 5 ]) # wraps, and the last sample is at the end of the ring
+    assert list(history.range()['time']) == [ 20, 20, 20 ]
+    assert list(history.range(start=20)['volume']) == [ -20, -15, -5 ]
+
+def test_record_and_export_csv():
+    history = ZoneStateHistory(capacity=10)
+    history.record(1, { 'power': True, 'volume': -30.0, 'source': '5' }, timestamp=1)
+    history.record(1, { 'power': False }, timestamp=2)
+
+    samples = history.range(1)
+    assert samples['flags'][0] == FLAG_POWER | FLAG_POWER_KNOWN
+    assert math.isnan(samples['volume'][1])
+    assert history.source_code(samples['source'][0]) == '5'
+
+    stream = io.StringIO()
+    history.export_csv(1, stream)
+    assert stream.getvalue().splitlines() == [ 'time,power,mute,volume,source', '1.0,True,,-30.0,5', '2.0,False,,,' ]
+
+def test_queries_do_not_create_zones():
+    history = ZoneStateHistory(capacity=10)
+    assert len(history.range(7)['time']) == 0
+    assert len(history.downsample(7, interval=60)['volume']) == 0
+
+    stream = io.StringIO()
+    history.export_csv(7, stream)
+    assert stream.getvalue().splitlines() == [ 'time,power,mute,volume,source' ]
+    assert history.zones == []
@@ -1 +1,112 @@
-"""FIXME: see https://github.com/nugget/python-anthemav/blob/master/tests/test_protocol.py"""
+"""Tests for the I/O free protocol core, exercised entirely in memory"""
+
+import pytest
+
+from anthemav_serial.config import PROTOCOL_CONFIG, RS232_RESPONSE_PATTERNS, pattern_to_dictionary
+from anthemav_serial.protocol import RS232Protocol
+
+GEN1 = 'anthem_rs232_gen1'
+GEN2 = 'anthem_rs232_gen2'
+
+class FakeClock(object):
+
+    def __init__(self, now: float = 100.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def engine(protocol_type=GEN1, clock=None, **overrides):
+    config = dict(PROTOCOL_CONFIG[protocol_type], **overrides)
+    return RS232Protocol(config, clock=clock or FakeClock())
+
+def test_receive_data_splits_lines():
+    gen1 = engine()
+    assert gen1.receive_data(b'P1S5V-30.0M0\nP2') == [ 'P1S5V-30.0M0' ]
+    assert gen1.buffered == b'P2'
+    assert gen1.receive_data(b'P1') == []
+    assert gen1.receive_data(b'\nZone3 Off\n') == [ 'P2P1', 'Zone3 Off' ]
+    assert gen1.buffered == b''
+
+def test_receive_data_accepts_memoryview():
+    gen1 = engine()
+    data = bytearray(b'P1M1\nP1')
+    assert gen1.receive_data(memoryview(data)[:5]) == [ 'P1M1' ]
+    assert gen1.receive_data(memoryview(data)[5:]) == []
+    assert gen1.receive_data(memoryview(b'P1\n')) == [ 'P1P1' ]
+
+def test_receive_data_end_of_line_split_across_reads():
+    crlf = engine(command_eol='\r\n')
+    assert crlf.receive_data(b'P1M1\r') == []
+    assert crlf.receive_data(b'\nP1M0\r\n') == [ 'P1M1', 'P1M0' ]
+
+def test_reset_discards_partial_line():
+    gen1 = engine()
+    gen1.receive_data(b'P1S5')
+    gen1.reset()
+    assert gen1.receive_data(b'P1M1\n') == [ 'P1M1' ]
+
+def test_frame():
+    gen1 = engine()
+    assert gen1.frame([ 'P1P1' ]) == b'P1P1\n'
+    assert gen1.frame([ 'P1S5', 'P1VM-30', 'P1?' ]) == b'P1S5;P1VM-30;P1?\n'
+    assert gen1.encode('set_volume', { 'zone': 1, 'volume': -30 }) == b'P1VM-30\n'
+    assert gen1.encode('no_such_command') is None
+    assert gen1.split('P1S5;P1VM-30;P1?') == [ 'P1S5', 'P1VM-30', 'P1?' ]
+
+    gen2 = engine(GEN2)
+    assert not gen2.supports_multiple_commands
+    assert gen2.frame([ 'Z1POW1' ]) == b'Z1POW1\n'
+    assert gen2.split('Z1POW1') == [ 'Z1POW1' ]
+    with pytest.raises(ValueError):
+        gen2.frame([ 'Z1POW1', 'Z1MUT0' ])
+
+def test_throttle_delay():
+    clock = FakeClock()
+    gen1 = engine(clock=clock)
+    assert gen1.throttle_delay() == 0
+
+    gen1.request_sent()
+    assert gen1.throttle_delay() == pytest.approx(0.25)
+    clock.now += 0.1
+    assert gen1.throttle_delay() == pytest.approx(0.15)
+    clock.now += 0.2
+    assert gen1.throttle_delay() == 0
+
+def test_delay_requests_after_power_on():
+    clock = FakeClock()
+    gen1 = engine(clock=clock)
+    gen1.request_sent()
+    gen1.delay_requests(gen1.delay_after_power_on)
+    clock.now += 1
+    assert gen1.throttle_delay() == pytest.approx(11)
+    assert gen1.throttle_delay(now=clock.now + 20) == 0
+
+def test_parse_converts_boolean_fields():
+    gen1 = engine()
+    assert gen1.parse('P1M1') == { 'zone': '1', 'mute': True }
+    assert gen1.parse('P2P0') == { 'zone': '2', 'power': False }
+    assert gen1.parse('garbage') is None
+
+def test_parse_zone_status():
+    gen1 = engine()
+    status = gen1.parse_zone_status('P1S5V-30.0M0')
+    assert (status['source'], status['volume'], status['mute'], status['power']) == ('5', '-30.0', False, True)
+    assert gen1.parse_zone_status('Zone2 Off') == { 'zone': 2, 'power': False }
+    assert gen1.zone_state(status) == (1, { 'power': True, 'mute': False, 'volume': -30.0, 'source': '5' })
+
+def test_match_command_and_is_query():
+    gen1 = engine()
+    assert gen1.match_command('P1VM-30') == ('set_volume', { 'zone': '1', 'volume': '-30' })
+    assert gen1.match_command('P1VM?') == ('volume_status', { 'zone': '1' })
+    assert gen1.is_query('P1?') and not gen1.is_query('P1P1')
+
+def test_is_version():
+    assert engine().is_version('(AVM 2,Version 1.00,Jun 26 2000)')
+    assert engine(GEN2).is_version('IDQMRX 1120 US 0.2.3Oct 23 2015')
+    assert not engine().is_version('P1M1')
+
+def test_pattern_to_dictionary():
+    match = RS232_RESPONSE_PATTERNS[GEN1]['mute_status'].match('P1M1')
+    assert pattern_to_dictionary(GEN1, match, 'P1M1') == { 'zone': '1', 'mute': True }
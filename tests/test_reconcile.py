@@ -0,0 +1,124 @@
+"""Tests for the desired state reconciler"""
+
+import os
+import re
+import asyncio
+import threading
+
+import pytest
+
+from anthemav_serial import get_amp_controller, get_async_amp_controller
+from anthemav_serial.reconcile import plan_commands, state_differences
+
+needs_pty = pytest.mark.skipif(not hasattr(os, 'openpty'), reason='needs a pty')
+
+def test_plan_orders_power_mute_settings_unmute_power_off():
+    current = { 1: { 'power': False }, 2: { 'power': True, 'mute': False, 'volume': -30.0, 'source': '5' } }
+    desired = {
+        1: { 'power': True, 'source': 6, 'volume': -35, 'mute': False },
+        2: { 'power': True, 'source': 3, 'mute': True },
+        3: { 'power': False, 'volume': -20 },
+    }
+    assert plan_commands(current, desired) == [
+        { 'power_on': { 'zone': 1 } },
+        { 'source_select': { 'zone': 1, 'source': 6 } },
+        { 'set_volume': { 'zone': 1, 'volume': -35 } },
+        { 'mute_off': { 'zone': 1 } },
+        { 'mute_on': { 'zone': 2 } },
+        { 'source_select': { 'zone': 2, 'source': 3 } },
+        { 'power_off': { 'zone': 3 } },
+    ]
+
+def test_plan_skips_no_ops():
+    current = { 1: { 'power': True, 'mute': False, 'volume': -30.0, 'source': '5' }, 3: { 'power': False } }
+    desired = { 1: { 'power': True, 'source': 5, 'volume': -30.1, 'mute': None }, 3: { 'power': False, 'volume': -20 } }
+    assert plan_commands(current, desired) == []
+    assert state_differences(current[1], { 'volume': -30.5 }) == { 'volume': -30.5 }
+
+def test_unknown_fields_rejected():
+    with pytest.raises(ValueError):
+        plan_commands({}, { 1: { 'loudness': 11 } })
+
+
+class FakeGen2Amp(object):
+    """Stateful Gen2 amplifier on a pty, answering per field queries"""
+
+    def __init__(self):
+        import tty
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.zones = { 1: dict(POW='0', MUT='0', VOL='-40', INP='2'), 2: dict(POW='1', MUT='0', VOL='-30', INP='5') }
+        self.received = []
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        buffer = b''
+        while True:
+            try:
+                buffer += os.read(self.master, 1024)
+            except OSError:
+                return
+            while b'\n' in buffer:
+                line, buffer = buffer.split(b'\n', 1)
+                line = line.decode()
+                self.received.append(line)
+                match = re.match(r'Z(\d)(POW|MUT|VOL|INP)(.+)', line)
+                if not match:
+                    continue
+                zone, field, value = int(match.group(1)), match.group(2), match.group(3)
+                state = self.zones[zone]
+                if value != '?':
+                    state[field] = value
+                elif field == 'POW' or state['POW'] == '1': # a zone that is off only reports power
+                    os.write(self.master, f"Z{zone}{field}{state[field]}\n".encode())
+
+    def close(self):
+        os.close(self.slave)
+        os.close(self.master)
+
+
+@pytest.fixture
+def gen2_amp():
+    fake = FakeGen2Amp()
+    yield fake
+    fake.close()
+
+
+def _fast(controller):
+    controller.engine.min_time_between_commands = 0.01
+    controller.engine.delay_after_power_on = 0.05
+    return controller
+
+@needs_pty
+def test_gen2_apply_state_converges_with_minimal_commands(gen2_amp):
+    amp = _fast(get_amp_controller('mrx2', gen2_amp.port))
+    desired = { 1: { 'power': True, 'source': 6, 'volume': -35.5, 'mute': False }, 2: { 'power': True, 'source': 5 } }
+
+    assert amp.apply_states(desired) == {}
+    assert gen2_amp.zones[1] == dict(POW='1', MUT='0', VOL='-35.5', INP='6')
+
+    # zone 1 was off, so only its power was read before the changes
+    writes = [ line for line in gen2_amp.received if not line.endswith('?') ]
+    assert writes == [ 'Z1POW1', 'Z1INP6', 'Z1VOL-35.5', 'Z1MUT0' ]
+
+    gen2_amp.received.clear()
+    assert amp.apply_states(desired) == {}
+    assert gen2_amp.received == []
+    assert amp.zone_status(1)['source'] == '6'
+
+@needs_pty
+def test_async_controller_tracks_echoed_events(amp):
+    async def run():
+        controller = _fast(await get_async_amp_controller('d2v', amp.port, asyncio.get_running_loop()))
+        await controller.zone_status(2)
+        amp.send_event(b'P2S3V-40.0M0') # e.g. zone 2 turned on at the front panel
+        await asyncio.sleep(0.1)
+
+        amp.received.clear()
+        unconverged = await controller.apply_state(2, { 'power': True, 'source': 3, 'volume': -40 })
+        controller._serial_client.close()
+        return unconverged
+
+    assert asyncio.run(run()) == {}
+    assert amp.received == []
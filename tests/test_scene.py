@@ -0,0 +1,44 @@
+"""Tests for scene compilation"""
+
+import pytest
+
+from anthemav_serial.config import PROTOCOL_CONFIG
+from anthemav_serial.protocol import RS232Protocol
+from anthemav_serial.scene import SceneWrite, compile_scene
+
+GEN1 = RS232Protocol(PROTOCOL_CONFIG['anthem_rs232_gen1'])
+GEN2 = RS232Protocol(PROTOCOL_CONFIG['anthem_rs232_gen2'])
+
+MOVIE_NIGHT = [
+    { 'source_select': { 'zone': 1, 'source': 5 } },
+    { 'set_volume': { 'zone': 1, 'volume': -30 } },
+    { 'power_on': { 'zone': 1 } },
+    { 'power_on': { 'zone': 2 } },
+    'query_version',
+    { 'power_off': { 'zone': 3 } },
+]
+
+def test_gen1_packs_commands_after_power_on():
+    writes = compile_scene(GEN1, 'movie_night', MOVIE_NIGHT)
+    assert writes == [
+        SceneWrite(b'P1P1;P2P1\n', GEN1.delay_after_power_on),
+        SceneWrite(b'P1S5;P1VM-30;?;P3P0\n', 0),
+    ]
+
+def test_gen2_sends_one_command_per_write():
+    writes = compile_scene(GEN2, 'movie_night', MOVIE_NIGHT[:4])
+    assert [ write.request for write in writes ] == [ b'Z1POW1\n', b'Z2POW1\n', b'Z1INP5\n', b'Z1VOL-30\n' ]
+    # the amp ignores requests during the lockout, so each separate power on write waits it out
+    assert [ write.delay_after for write in writes ] == [ GEN2.delay_after_power_on ] * 2 + [ 0, 0 ]
+
+def test_power_on_not_hoisted_past_earlier_power_command():
+    writes = compile_scene(GEN1, 'cycle', [ { 'power_off': { 'zone': 1 } }, { 'power_on': { 'zone': 1 } } ])
+    assert writes == [ SceneWrite(b'P1P0;P1P1\n', GEN1.delay_after_power_on) ]
+
+def test_invalid_scenes_rejected():
+    with pytest.raises(ValueError, match='unknown command'):
+        compile_scene(GEN1, 'bad', [ 'no_such_command' ])
+    with pytest.raises(ValueError, match='invalid arguments'):
+        compile_scene(GEN1, 'bad', [ { 'power_on': {} } ])
+    with pytest.raises(ValueError, match='single'):
+        compile_scene(GEN1, 'bad', [ { 'power_on': { 'zone': 1 }, 'power_off': { 'zone': 2 } } ])
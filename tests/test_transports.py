@@ -0,0 +1,58 @@
+"""Tests for the interchangeable asyncio transports"""
+
+import os
+import sys
+import asyncio
+import subprocess
+
+import pytest
+import serial
+
+from anthemav_serial import get_async_amp_controller
+from anthemav_serial.transports import (TRANSPORTS, TRANSPORT_SERIAL, TRANSPORT_FD, TRANSPORT_TCP, FdTransport,
+                                        get_transport_opener)
+
+def test_auto_picks_tcp_for_network_urls():
+    assert get_transport_opener('auto', 'socket://localhost:4999') is TRANSPORTS[TRANSPORT_TCP]
+    assert get_transport_opener('auto', 'tcp://localhost:4999') is TRANSPORTS[TRANSPORT_TCP]
+    assert get_transport_opener('auto', '/dev/ttyUSB0') is TRANSPORTS[TRANSPORT_SERIAL]
+    with pytest.raises(ValueError):
+        get_transport_opener('carrier-pigeon', '/dev/ttyUSB0')
+
+def test_import_without_termios():
+    # as on Windows: the package must import, just without the 'fd' transport (pyserial itself is imported
+    # first, since it picks its own platform backend)
+    code = ("import os, sys, serial, serial_asyncio; sys.modules['termios'] = None; os.name = 'nt'; "
+            "import anthemav_serial, anthemav_serial.transports as t; assert 'fd' not in t.TRANSPORTS")
+    subprocess.run([ sys.executable, '-c', code ], check=True, cwd=os.path.dirname(os.path.dirname(__file__)))
+
+@pytest.mark.skipif(not hasattr(os, 'openpty'), reason='needs a pty')
+@pytest.mark.parametrize('transport', [ TRANSPORT_SERIAL, TRANSPORT_FD ])
+def test_zone_status_over_pty(amp, transport):
+    async def run():
+        controller = await get_async_amp_controller('d2v', amp.port, asyncio.get_running_loop(), transport=transport)
+        status = await controller.zone_status(2)
+        controller._serial_client.close()
+        return status
+
+    assert asyncio.run(run()) == { 'zone': 2, 'power': False }
+
+@pytest.mark.skipif(not hasattr(os, 'openpty'), reason='needs a pty')
+def test_fd_transport_closed_before_reader_registered(amp):
+    class Protocol(asyncio.Protocol):
+        def __init__(self):
+            self.lost = asyncio.get_running_loop().create_future()
+
+        def connection_lost(self, exc):
+            self.lost.set_result(exc)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        protocol = Protocol()
+        transport = FdTransport(loop, protocol, serial.serial_for_url(amp.port))
+        fd = transport._fd
+        transport.close() # before the scheduled callbacks run
+        await protocol.lost
+        return loop.remove_reader(fd) # False when no reader was ever left registered
+
+    assert asyncio.run(run()) is False
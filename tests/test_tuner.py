@@ -0,0 +1,109 @@
+"""Tests for the I/O free tuner plans"""
+
+import pytest
+
+from anthemav_serial.config import PROTOCOL_CONFIG
+from anthemav_serial.protocol import RS232Protocol
+from anthemav_serial.tuner import DEFAULT_SEEK_SETTLE, Tuner, TunerRequest, preset_plan, scan_plan
+
+GEN1 = RS232Protocol(PROTOCOL_CONFIG['anthem_rs232_gen1'])
+GEN2 = RS232Protocol(PROTOCOL_CONFIG['anthem_rs232_gen2'])
+
+def run_plan(plan, reply):
+    """Drive a plan, passing every request to reply(request) and answering those that expect a reply"""
+    requests = []
+    try:
+        step = next(plan)
+        while True:
+            requests.append(step)
+            answer = reply(step.request)
+            step = plan.send(answer if step.expects_reply else None)
+    except StopIteration as done:
+        return done.value, requests
+
+def test_preset_requires_bank_on_gen1():
+    with pytest.raises(ValueError, match='requires a preset bank'):
+        next(preset_plan(GEN1, 'fm', 2))
+
+    frequency, requests = run_plan(preset_plan(GEN1, 'fm', 2, bank=1), lambda request: 'TFT101.1')
+    assert frequency == 101.1
+    assert requests[0].request == b'TFP12;TT?\n'
+
+def test_preset_rejects_bank_on_gen2():
+    with pytest.raises(ValueError, match='no preset banks'):
+        next(preset_plan(GEN2, 'fm', 2, bank=1))
+
+    frequency, requests = run_plan(preset_plan(GEN2, 'fm', 2), lambda request: 'T1FMS98.5')
+    assert frequency == 98.5
+    assert [ step.request for step in requests ] == [ b'T1PSL2\n', b'T1FMS?\n' ]
+
+def _seeking_tuner(stations):
+    """Reply to frequency queries as a tuner seeking through the given stations, wrapping around"""
+    position = [ -1 ]
+    def reply(request):
+        if request.startswith(b'T+'): # also 'T+;TT?'
+            position[0] = (position[0] + 1) % len(stations)
+        return f"TFT{stations[position[0]]:.1f}"
+    return reply
+
+def test_scan_settles_before_reading_frequency():
+    stations = [ 88.1, 94.5, 101.1 ]
+    found, requests = run_plan(scan_plan(GEN1, 'fm'), _seeking_tuner(stations))
+    assert found == stations
+
+    # the seek and the frequency query are separate writes, with the settle time in between
+    assert requests[1] == TunerRequest(b'T+\n', False, DEFAULT_SEEK_SETTLE)
+    assert requests[2] == TunerRequest(b'TT?\n', True, 0)
+
+def test_scan_stops_when_frequency_does_not_change():
+    found, _ = run_plan(scan_plan(GEN1, 'fm', settle=0), lambda request: 'TFT94.5')
+    assert found == [ 94.5 ]
+
+def test_scan_detects_stepping_instead_of_seeking():
+    channels = [ round(87.5 + step * 0.1, 1) for step in range(205) ]
+    with pytest.raises(ValueError, match='stepped'):
+        run_plan(scan_plan(GEN1, 'fm', settle=0), _seeking_tuner(channels))
+
+def test_scan_aborted_when_frequency_is_missing():
+    replies = iter([ 'TFT88.1', 'TFT94.5', None ]) # a timeout after two stations
+    with pytest.raises(ValueError, match='scan aborted'):
+        run_plan(scan_plan(GEN1, 'fm'), lambda request: next(replies) if request == b'TT?\n' else None)
+
+class FakeAmp(object):
+
+    def __init__(self, engine, series, serial_port_path, reply=None):
+        self.engine = engine
+        self.series = series
+        self.serial_port_path = serial_port_path
+        self._reply = reply
+
+    def send_request(self, request, wait_for_reply=True, delay_after=0):
+        return self._reply(request) if wait_for_reply else None
+
+def test_aborted_scan_is_not_cached(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    tuner = Tuner(FakeAmp(GEN1, 'd2v', '/dev/ttyUSB0', reply=lambda request: None))
+    with pytest.raises(ValueError):
+        tuner.scan('fm', settle=0)
+    assert tuner.stations('fm') is None
+
+    tuner = Tuner(FakeAmp(GEN1, 'd2v', '/dev/ttyUSB0', reply=_seeking_tuner([ 88.1, 94.5 ])))
+    assert tuner.scan('fm', settle=0) == [ 88.1, 94.5 ]
+
+def test_cache_is_per_amplifier(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    gen1 = Tuner(FakeAmp(GEN1, 'd2v', '/dev/ttyUSB0'))
+    gen2 = Tuner(FakeAmp(GEN2, 'mrx2', 'socket://amp:4999'))
+    gen1.cache.set_stations('fm', [ 88.1 ])
+    gen2.cache.set_stations('fm', [ 101.1 ])
+
+    assert Tuner(FakeAmp(GEN1, 'd2v', '/dev/ttyUSB0')).stations('fm') == [ 88.1 ]
+    assert Tuner(FakeAmp(GEN2, 'mrx2', 'socket://amp:4999')).stations('fm') == [ 101.1 ]
+    assert Tuner(FakeAmp(GEN1, 'd2v', '/dev/ttyUSB1')).stations('fm') is None
+
+def test_preset_keys_are_unambiguous(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    tuner = Tuner(FakeAmp(GEN1, 'd2v', '/dev/ttyUSB0', reply=lambda request: 'TFT88.1'))
+    tuner.recall_preset('fm', 12, bank=1)
+    tuner.recall_preset('fm', 2, bank=11)
+    assert sorted(tuner.cache.presets('fm')) == [ '1-12', '11-2' ]